@@ -1,6 +1,48 @@
 import numpy as np
 import cv2
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+_tile_executors = {} # thread pools of the tiled detection, by number of threads
+_tile_executors_lock = threading.Lock()
+
+
+def tile_executor(workers):
+    """
+    Thread pool with workers threads used for the tiles of the tiled detection,
+    shared by all the ImageManagers (e.g. the ones of the frames of a pipeline)
+    """
+    with _tile_executors_lock:
+        executor = _tile_executors.get(workers)
+        if executor is None:
+            executor = _tile_executors[workers] = ThreadPoolExecutor(workers, thread_name_prefix='tiles')
+        return executor
+
+
+def object_dtype(Nchannels):
+    """
+    Dtype of the rows of the object table of ImageManager: 
+    id (-1 if the object is not tracked), centroid, area, bounding box (left, top, width, height)
+    and intensity of each channel at the centroid
+    """
+    return np.dtype([('id', np.int64),
+                     ('cx', np.int32),
+                     ('cy', np.int32),
+                     ('area', np.float64),
+                     ('bbox', np.int32, (4,)),
+                     ('intensity', np.float64, (Nchannels,))])
+
+
+def statistics_dtype(Nchannels):
+    """
+    Dtype of the rows of the statistics table of ImageManager: id and area (in pixels) of the object,
+    integrated intensity, peak and background (mean per pixel) in each channel
+    """
+    return np.dtype([('id', np.int64),
+                     ('area', np.int64),
+                     ('integrated', np.float64, (Nchannels,)),
+                     ('peak', np.float64, (Nchannels,)),
+                     ('background', np.float64, (Nchannels,))])
 
 
 class ImageManager:
@@ -12,64 +54,475 @@ class ImageManager:
                  roisize,
                  min_object_area=10,
                  max_object_area=100,
-                 Nchannels = 2, dtype=np.uint16):
+                 Nchannels = 2, dtype=np.uint16,
+                 engine = 'contours',
+                 threshold_method = 'otsu',
+                 fixed_threshold = 1000,
+                 tile_size = 0,
+                 tile_workers = 4,
+                 redetect_period = 10):
 
         self.image = np.zeros((Nchannels,dim_v,dim_h),dtype) # original 16 bit images from the N channels   
         self.dim_h = dim_h
         self.dim_v = dim_v
         
-        self.contours = []        # list of contours of the detected objects
-        self.cx = []             # list of the x coordinates of the centroids of the detected object
-        self.cy = []             # list of the y coordinates of the centroids of the detected object
+        self.objects = np.zeros(0, object_dtype(Nchannels))  # table of the detected objects
+        self._contour_points = np.zeros((0, 2), np.int32)   # points (x, y) of the contours of all the objects
+        self._contour_offsets = np.zeros(1, np.int64)       # contour k is contour_points[offsets[k]:offsets[k+1]]
+        self.labels = None       # label image of the 'components' engine
+        self.statistics = np.zeros(0, statistics_dtype(Nchannels))  # statistics of the detected objects
+        self.object_labels = []  # labels of the detected objects in the label image
          
+        self.engine = engine     # detection engine: 'contours' or 'components' 
+        self.threshold_method = threshold_method  # 'otsu', 'triangle' or 'fixed'
+        self.fixed_threshold = fixed_threshold    # threshold used by the 'fixed' method
+        self.tile_size = tile_size        # size of the tiles processed in parallel by the 'contours' engine, 0 for no tiling
+        self.tile_workers = tile_workers  # threads used for the tiles
+        self.redetect_period = redetect_period  # frames between two full frame detections of track_object
+        self.next_id = 0                        # id of the next new object
+        self.frames_since_detection = 0
+        self.track_channel = None               # channel and threshold of the last full frame detection
+        self.track_threshold = None
+        self.histograms = {}     # 16 bit histogram of each channel of the current frame
+        self.thresholds = {}     # threshold of each channel of the current frame
         self.roisize = roisize        # roi size
         self.min_object_area = min_object_area    # minimum area that the object must have to be recognized as a object
         self.max_object_area = max_object_area    # maximum area that the object can have to be recognized as a object
 
+    @property
+    def cx(self):
+        # x coordinates of the centroids of the detected objects
+        return self.objects['cx']
+
+    @property
+    def cy(self):
+        # y coordinates of the centroids of the detected objects
+        return self.objects['cy']
+
+    @property
+    def ids(self):
+        # persistent ids of the objects followed by track_object
+        return self.objects['id']
+
+    @property
+    def contour_points(self):
+        if self._contour_points is None:
+            self.set_contours([self.extract_contour(indx) for indx in range(len(self.objects))])
+        return self._contour_points
+
+    @property
+    def contour_offsets(self):
+        if self._contour_offsets is None:
+            self.set_contours([self.extract_contour(indx) for indx in range(len(self.objects))])
+        return self._contour_offsets
+
+    @property
+    def contours(self):
+        """
+        list of contours of the detected objects, in the format of cv2.findContours (views of contour_points)
+        """
+        points = self.contour_points
+        offsets = self.contour_offsets
+        return [points[o0:o1].reshape(-1, 1, 2) for o0, o1 in zip(offsets[:-1], offsets[1:])]
+
+    def set_contours(self, contours):
+        """ Input: 
+             contours: list of contours of the objects
+        Stores the contours in the flat buffer contour_points, with their offsets
+        """
+        offsets = np.zeros(len(contours)+1, np.int64)
+        np.cumsum([len(cnt) for cnt in contours], out=offsets[1:])
+        if contours:
+            self._contour_points = np.concatenate([cnt.reshape(-1, 2) for cnt in contours]).astype(np.int32, copy=False)
+        else:
+            self._contour_points = np.zeros((0, 2), np.int32)
+        self._contour_offsets = offsets
+
+    def set_objects(self, cx, cy, area, contours=None, bboxes=None, ids=None):
+        """ Input: 
+             cx, cy, area: centroids and areas of the objects
+             contours: list of contours of the objects, None if they are extracted lazily
+             bboxes: bounding boxes of the objects, computed from the contours if None
+             ids: ids of the objects, -1 (not tracked) if None
+        Builds the object table, with the intensity of each channel at the centroids
+        """
+        objects = np.zeros(len(cx), self.objects.dtype)
+        objects['id'] = -1 if ids is None else ids
+        objects['cx'] = cx
+        objects['cy'] = cy
+        objects['area'] = area
+        if contours is None:
+            self._contour_points = None
+            self._contour_offsets = None
+        else:
+            self.set_contours(contours)
+        if bboxes is None and len(objects) > 0:
+            points = self.contour_points
+            starts = self.contour_offsets[:-1]
+            left = np.minimum.reduceat(points[:, 0], starts)
+            top = np.minimum.reduceat(points[:, 1], starts)
+            bboxes = np.stack([left, top,
+                               np.maximum.reduceat(points[:, 0], starts) - left + 1,
+                               np.maximum.reduceat(points[:, 1], starts) - top + 1], axis=1)
+        if bboxes is not None:
+            objects['bbox'] = bboxes
+        objects['intensity'] = self.image[:, objects['cy'], objects['cx']].T
+        self.objects = objects
+
     def clear_countours(self):
-        self.contours = []        
-        self.cx = []             
-        self.cy = []
+        self.set_objects([], [], [], contours=[])
+        self.labels = None
+        self.object_labels = []
+        self.track_channel = None
+
+    def clear_histograms(self):
+        """
+        To be called when a new frame is written in image: drops the histograms and thresholds of the previous one
+        """
+        self.histograms = {}
+        self.thresholds = {}
+
+    def get_histogram(self, ch):
+        """ Input: 
+             ch: selected channel
+            Output:
+        16 bit histogram (65536 bins) of the channel, computed once per frame
+        """
+        hist = self.histograms.get(ch)
+        if hist is None:
+            hist = cv2.calcHist([self.image[ch]], [0], None, [65536], [0, 65536]).ravel()
+            self.histograms[ch] = hist
+        return hist
+
+    def get_threshold(self, ch):
+        """ Input: 
+             ch: selected channel
+            Output:
+        threshold of the channel, derived from its histogram with threshold_method
+        """
+        threshold = self.thresholds.get(ch)
+        if threshold is None:
+            if self.threshold_method == 'fixed':
+                threshold = self.fixed_threshold
+            elif self.threshold_method == 'triangle':
+                threshold = self.triangle_threshold(self.get_histogram(ch))
+            else:
+                threshold = self.otsu_threshold(self.get_histogram(ch))
+            self.thresholds[ch] = threshold
+        return threshold
+
+    def get_levels(self, ch):
+        """ Input: 
+             ch: selected channel
+            Output:
+        min and max value of the channel, for the display levels, from its histogram
+        """
+        levels = np.flatnonzero(self.get_histogram(ch))
+        if levels.size == 0:
+            return 0, 0
+        return int(levels[0]), int(levels[-1])
+
+    @staticmethod
+    def otsu_threshold(hist):
+        """
+        Otsu threshold of a histogram: maximizes the between-class variance of
+        the values <= threshold and > threshold
+        """
+        levels = np.flatnonzero(hist)
+        if levels.size < 2:
+            return int(levels[0]) if levels.size else 0
+        lo, hi = levels[0], levels[-1]
+        h = hist[lo:hi+1].astype(np.float64)
+        values = np.arange(lo, hi+1)
+        w0 = np.cumsum(h)
+        w1 = w0[-1] - w0
+        m0 = np.cumsum(h*values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = w0*w1*(m0/w0 - (m0[-1]-m0)/w1)**2
+        variance[w1 == 0] = 0
+        return int(lo + np.argmax(variance))
+
+    @staticmethod
+    def triangle_threshold(hist):
+        """
+        Triangle threshold of a histogram: the value with the largest distance from the line
+        joining the histogram peak to the end of its longest tail
+        """
+        levels = np.flatnonzero(hist)
+        if levels.size < 2:
+            return int(levels[0]) if levels.size else 0
+        lo, hi = levels[0], levels[-1]
+        peak = int(np.argmax(hist))
+        end = hi if hi - peak >= peak - lo else lo
+        if end == peak:
+            return peak
+        values = np.arange(min(peak, end), max(peak, end)+1)
+        h = hist[values].astype(np.float64)
+        hp, he = float(hist[peak]), float(hist[end])
+        distance = np.abs((he-hp)*(values-peak) - (end-peak)*(h-hp))
+        return int(values[np.argmax(distance)])
+
+    def threshold(self, ch):
+        """ Input: 
+             ch: channel to process
+            Output:
+        thresh: binary image (threshold of the 16 bit image followed by a morphological opening)
+        """
+        thresh_pre = cv2.compare(self.image[ch], float(self.get_threshold(ch)), cv2.CMP_GT)
+        # thresh_pre is 255 where the image is above the threshold
+        kernel  = np.ones((2,2),np.uint8)
+        thresh = cv2.morphologyEx(thresh_pre,cv2.MORPH_OPEN, kernel, iterations = 1)
+        # morphological opening (removes noise)
+        return thresh
         
     def find_object(self, ch):    # ch: selected channel       
         """ Input: 
-             ch: channel to use to create the 8 bit image to process
+             ch: channel to process
         Determines if a region avove thresold is a object, generates contours of the objects and their centroids cx and cy      
         """          
+        if self.engine == 'components':
+            self.find_object_components(ch)
+            return
+        if self.tile_size > 0:
+            self.find_object_tiled(ch)
+            return
     
-        image8bit = (self.image[ch]/256).astype('uint8')
-        
-        _ret,thresh_pre = cv2.threshold(image8bit,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-        # ret is the threshold that was used, thresh is the thresholded image.     
-        kernel  = np.ones((2,2),np.uint8)
-        thresh = cv2.morphologyEx(thresh_pre,cv2.MORPH_OPEN, kernel, iterations = 1)
-        # morphological opening (removes noise)
+        thresh = self.threshold(ch)
         cnts, _hierarchy = cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+        self.select_contours(cnts, thresh.shape)
+
+    def select_contours(self, cnts, l):
+        """ Input: 
+             cnts: contours found in the thresholded image
+             l: shape of the image
+        Keeps the contours with area between min_object_area and max_object_area and roi far from the edges
+        and builds the object table and the contour buffer
+        """          
         cx = []
         cy = []            
+        area = []
         contours = []
+        
+        for cnt in cnts:
+            accepted = self.accept_contour(cnt, l)
+            if accepted is not None:
+                cx.append(accepted[0])
+                cy.append(accepted[1])
+                area.append(accepted[2])
+                contours.append(cnt)
+        
+        self.set_objects(cx, cy, area, contours)
+        self.labels = None
+        self.object_labels = []
+
+    def accept_contour(self, cnt, l):
+        """ Input: 
+             cnt: contour
+             l: shape of the image
+            Output:
+        centroid and area (x0, y0, area) of the contour if it is a object (area between min_object_area 
+        and max_object_area and roi far from the edges), None otherwise
+        """
         roisize = self.roisize
-        l = image8bit.shape
+        M = cv2.moments(cnt)
+        if M['m00'] >  int(self.min_object_area) and M['m00'] < int(self.max_object_area): 
+            # (M['m00'] gives the contour area, also as cv2.contourArea(cnt)
+            x0 = int(M['m10']/M['m00']) 
+            y0 = int(M['m01']/M['m00'])
+            x = int(x0 - roisize//2) 
+            y = int(y0 - roisize//2)
+            w = h = roisize
+    
+            if x>0 and y>0 and x+w<l[1]-1 and y+h<l[0]-1:    # only rois far from edges are considered
+                return x0, y0, M['m00']
+        return None
+
+    def track_object(self, ch):
+        """ Input: 
+             ch: channel to process
+        Follows the objects of the previous frame, searching each of them in a window of 2*roisize pixels
+        around its previous centroid, with the threshold of the last full frame detection.
+        A full frame detection (find_object) is done every redetect_period frames, when a object is lost
+        or when the channel changes; new objects are found only by the full frame detection.
+        The objects keep their persistent ids in the id field of the object table
+        """
+        prev = self.objects
+        self.frames_since_detection += 1
+        if (self.track_channel == ch and self.frames_since_detection < self.redetect_period
+                and np.all(prev['id'] >= 0)):
+            found = [self.track_window(ch, int(x0), int(y0)) for x0, y0 in zip(prev['cx'], prev['cy'])]
+            centroids = [obj[1:3] for obj in found if obj is not None]
+            if len(centroids) == len(found) and len(set(centroids)) == len(found):
+                # all the objects found, each in a different place
+                self.set_objects([obj[1] for obj in found],
+                                 [obj[2] for obj in found],
+                                 [obj[3] for obj in found],
+                                 [obj[0] for obj in found],
+                                 ids=prev['id'])
+                self.labels = None
+                self.object_labels = []
+                return
         
+        self.find_object(ch)
+        self.track_channel = ch
+        self.track_threshold = float(self.get_threshold(ch))
+        self.frames_since_detection = 0
+        self.objects['id'] = self.match_ids(prev)
+
+    def track_window(self, ch, x0, y0):
+        """ Input: 
+             ch: channel to process
+             x0, y0: previous centroid of the object
+            Output:
+        (contour, cx, cy, area) of the object nearest to x0, y0 in the search window, or None if it is lost
+        """
+        roisize = self.roisize
+        l = self.image.shape[1:]
+        wy0, wy1 = max(y0-roisize, 0), min(y0+roisize, l[0])
+        wx0, wx1 = max(x0-roisize, 0), min(x0+roisize, l[1])
+        thresh_pre = cv2.compare(self.image[ch, wy0:wy1, wx0:wx1], self.track_threshold, cv2.CMP_GT)
+        kernel  = np.ones((2,2),np.uint8)
+        thresh = cv2.morphologyEx(thresh_pre,cv2.MORPH_OPEN, kernel, iterations = 1)
+        cnts, _hierarchy = cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE,
+                                            offset=(wx0, wy0))
+        best = None
+        max_distance2 = (roisize//2)**2 # maximum displacement between two frames
         for cnt in cnts:
-            
-            M = cv2.moments(cnt)
-            if M['m00'] >  int(self.min_object_area) and M['m00'] < int(self.max_object_area): 
-                # (M['m00'] gives the contour area, also as cv2.contourArea(cnt)
-                x0 = int(M['m10']/M['m00']) 
-                y0 = int(M['m01']/M['m00'])
-                x = int(x0 - roisize//2) 
-                y = int(y0 - roisize//2)
-                w = h = roisize
+            accepted = self.accept_contour(cnt, l)
+            if accepted is not None:
+                distance2 = (accepted[0]-x0)**2 + (accepted[1]-y0)**2
+                if distance2 <= max_distance2 and (best is None or distance2 < best[0]):
+                    best = (distance2, cnt, *accepted)
+        return None if best is None else best[1:]
+
+    def match_ids(self, prev):
+        """ Input: 
+             prev: object table of the previous frame
+            Output:
+        ids of the detected objects: the id of the nearest previous object (closer than roisize//2),
+        a new id if there is none
+        """
+        ids = [None]*len(self.objects)
+        prev_ids = prev['id']
+        if np.all(prev_ids >= 0) and len(prev_ids) > 0 and len(ids) > 0:
+            distance2 = (np.subtract.outer(self.cx.astype(int), prev['cx'].astype(int))**2
+                         + np.subtract.outer(self.cy.astype(int), prev['cy'].astype(int))**2)
+            used = set()
+            for k in np.argsort(distance2, axis=None):
+                indx, prev_indx = divmod(int(k), len(prev_ids))
+                if distance2[indx, prev_indx] > (self.roisize//2)**2:
+                    break
+                if ids[indx] is None and prev_indx not in used:
+                    ids[indx] = prev_ids[prev_indx]
+                    used.add(prev_indx)
+        for indx, obj_id in enumerate(ids):
+            if obj_id is None:
+                ids[indx] = self.next_id
+                self.next_id += 1
+        return ids
+
+    def find_object_tiled(self, ch):
+        """ Input: 
+             ch: channel to process
+        Same as find_object, with threshold, opening and contour detection done in parallel threads
+        on tiles of tile_size pixels, overlapping by roisize pixels.
+        Each object is taken from the tile whose core contains its first (top left) contour point.
+        If an object is larger than the overlap (it reaches the inner edges of the tile)
+        the detection is repeated on the whole frame, so the result is always identical to find_object      
+        """
+        threshold = float(self.get_threshold(ch))
+        l = self.image.shape[1:]
+        tile = self.tile_size
+        cores = [(y0, min(y0+tile, l[0]), x0, min(x0+tile, l[1]))
+                 for y0 in range(0, l[0], tile) for x0 in range(0, l[1], tile)]
+        results = list(tile_executor(self.tile_workers).map(lambda core: self.find_contours_tile(ch, threshold, core), cores))
+        
+        if any(cnts is None for cnts in results):
+            thresh = self.threshold(ch)
+            cnts, _hierarchy = cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+        else:
+            cnts = [cnt for tile_cnts in results for cnt in tile_cnts]
+            # same order of cv2.findContours on the whole frame
+            cnts.sort(key=lambda cnt: (cnt[0,0,1], cnt[0,0,0]), reverse=True)
+        self.select_contours(cnts, l)
+
+    def find_contours_tile(self, ch, threshold, core):
+        """ Input: 
+             ch: channel to process
+             threshold: threshold of the whole channel
+             core: (y0, y1, x0, x1) core of the tile
+            Output:
+        contours (in frame coordinates) of the objects with the first point in the core,
+        or None if one of them reaches the inner edges of the tile
+        """
+        pad = 2 # pixels at the inner edges of the tile affected by the morphological opening 
+        margin = self.roisize + pad
+        l = self.image.shape[1:]
+        cy0, cy1, cx0, cx1 = core
+        wy0, wy1 = max(cy0-margin, 0), min(cy1+margin, l[0])
+        wx0, wx1 = max(cx0-margin, 0), min(cx1+margin, l[1])
+        
+        thresh_pre = cv2.compare(self.image[ch, wy0:wy1, wx0:wx1], threshold, cv2.CMP_GT)
+        kernel  = np.ones((2,2),np.uint8)
+        thresh = cv2.morphologyEx(thresh_pre,cv2.MORPH_OPEN, kernel, iterations = 1)
+        cnts, _hierarchy = cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE,
+                                            offset=(wx0, wy0))
+        # inner edges of the tile (the edges of the frame are not inner edges)
+        ymin = wy0+pad if wy0 > 0 else -1
+        ymax = wy1-pad if wy1 < l[0] else l[0]
+        xmin = wx0+pad if wx0 > 0 else -1
+        xmax = wx1-pad if wx1 < l[1] else l[1]
+        contours = []
+        for cnt in cnts:
+            x0, y0 = cnt[0,0]
+            if not (cy0 <= y0 < cy1 and cx0 <= x0 < cx1):
+                continue # taken from another tile
+            xs = cnt[:,0,0]
+            ys = cnt[:,0,1]
+            if xs.min() < xmin or xs.max() >= xmax or ys.min() < ymin or ys.max() >= ymax:
+                return None
+            contours.append(cnt)
+        return contours
+
+    def find_object_components(self, ch):
+        """ Input: 
+             ch: channel to process
+        Same as find_object, using the connected components of the thresholded image.
+        Area, centroid and bounding box of all the components are computed by OpenCV,
+        the filtering on area and distance from the edges is vectorized.
+        The contours are extracted only when accessed, and only for the detected objects.
+        Note that the area is the number of pixels of the component, slightly larger than the contour area  
+        """
+        thresh = self.threshold(ch)
+        _num, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+        # label 0 is the background
+        area = stats[1:, cv2.CC_STAT_AREA]
+        cx = centroids[1:, 0].astype(int)
+        cy = centroids[1:, 1].astype(int)
+        roisize = self.roisize
+        l = thresh.shape
+        x = cx - roisize//2
+        y = cy - roisize//2
         
-                if x>0 and y>0 and x+w<l[1]-1 and y+h<l[0]-1:    # only rois far from edges are considered
-                    cx.append(x0)
-                    cy.append(y0)
-                    contours.append(cnt)
+        selected = ((area > int(self.min_object_area)) & (area < int(self.max_object_area))
+                    & (x > 0) & (y > 0) & (x+roisize < l[1]-1) & (y+roisize < l[0]-1)) # only rois far from edges are considered
         
-        self.cx = cx
-        self.cy = cy 
-        self.contours = contours  
+        self.labels = labels
+        self.object_labels = np.flatnonzero(selected) + 1
+        self.set_objects(cx[selected], cy[selected], area[selected],
+                         bboxes=stats[self.object_labels, :4]) # the contours are extracted lazily
+
+    def extract_contour(self, indx):
+        """ Input: 
+        indx: index of a object detected by find_object_components
+            Output:
+        contour of the object, in the format of cv2.findContours
+        """
+        left, top, width, height = self.objects['bbox'][indx]
+        mask = (self.labels[top:top+height, left:left+width] == self.object_labels[indx]).astype(np.uint8)
+        cnts, _hierarchy = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                            offset=(int(left), int(top)))
+        return max(cnts, key=len)
 
     def copy(self):
         """
@@ -80,15 +533,98 @@ class ImageManager:
             self.dim_v,
             self.roisize,
             min_object_area=self.min_object_area,
+            max_object_area=self.max_object_area,
             Nchannels=self.image.shape[0],
-            dtype=self.image.dtype
+            dtype=self.image.dtype,
+            engine=self.engine,
+            threshold_method=self.threshold_method,
+            fixed_threshold=self.fixed_threshold,
+            tile_size=self.tile_size,
+            tile_workers=self.tile_workers,
+            redetect_period=self.redetect_period
         )
         new_im.image = self.image.copy()
-        new_im.contours = [cnt.copy() for cnt in self.contours]
-        new_im.cx = self.cx.copy()
-        new_im.cy = self.cy.copy()
+        new_im.histograms = dict(self.histograms)
+        new_im.thresholds = dict(self.thresholds)
+        new_im._contour_points = self.contour_points.copy()
+        new_im._contour_offsets = self.contour_offsets.copy()
+        new_im.objects = self.objects.copy()
         return new_im
 
+    def take_state(self, other):
+        """
+        Takes (by reference, no copy) the detected objects and the tracking state of other,
+        the ImageManager of the previous frame, to continue the detection on the frame in this image
+        """
+        self.objects = other.objects
+        self._contour_points = other._contour_points
+        self._contour_offsets = other._contour_offsets
+        self.labels = other.labels
+        self.object_labels = other.object_labels
+        self.next_id = other.next_id
+        self.frames_since_detection = other.frames_since_detection
+        self.track_channel = other.track_channel
+        self.track_threshold = other.track_threshold
+
+
+    def object_label_image(self):
+        """
+            Output:
+        label image of the detected objects: pixels of object k have label k+1, the others 0.
+        With the 'components' engine it is remapped from the component labels,
+        otherwise the contours are filled (holes included)
+        """
+        if self.labels is not None and len(self.object_labels) == len(self.objects):
+            lut = np.zeros(self.labels.max()+1, np.int32)
+            lut[self.object_labels] = np.arange(1, len(self.objects)+1)
+            return lut[self.labels]
+        label_image = np.zeros(self.image.shape[1:], np.int32)
+        for indx, cnt in enumerate(self.contours):
+            cv2.drawContours(label_image, [cnt], 0, indx+1, -1)
+        return label_image
+
+    def compute_statistics(self):
+        """
+            Output:
+        statistics table of the detected objects (also stored in self.statistics), 
+        for all the objects and channels at once:
+        area in pixels, integrated intensity and peak of the object pixels, and background, 
+        the mean of the pixels of the roi that do not belong to any object
+        """
+        n = len(self.objects)
+        nch = self.image.shape[0]
+        statistics = np.zeros(n, self.statistics.dtype)
+        statistics['id'] = self.objects['id']
+        if n == 0:
+            self.statistics = statistics
+            return statistics
+        label_image = self.object_label_image()
+        
+        # only the object pixels, sorted by label, are reduced
+        pixels = np.flatnonzero(label_image)
+        labels = label_image.ravel()[pixels]
+        order = np.argsort(labels, kind='stable')
+        pixels = pixels[order]
+        labels = labels[order]
+        values = self.image.reshape(nch, -1)[:, pixels].astype(np.float64)
+        area = np.bincount(labels, minlength=n+1)[1:]
+        starts = np.concatenate(([0], np.cumsum(area)[:-1]))
+        present = area > 0 # an object fully covered by another one has no pixels
+        statistics['area'] = area
+        statistics['integrated'][present] = np.add.reduceat(values, starts[present], axis=1).T
+        statistics['peak'][present] = np.maximum.reduceat(values, starts[present], axis=1).T
+        
+        # background from the rois of all the objects at once, (N, Nchannels, roisize, roisize)
+        rois = self.extract_rois_batch(self.cx, self.cy)
+        x, y = self.roi_origins(self.cx, self.cy)
+        roisize = self.roisize
+        windows = np.lib.stride_tricks.sliding_window_view(label_image, (roisize, roisize))
+        background = (windows[y, x] == 0)[:, np.newaxis] # (N, 1, roisize, roisize)
+        count = background.sum(axis=(2, 3))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistics['background'] = np.where(count > 0, (rois*background).sum(axis=(2, 3))/count, 0)
+        self.statistics = statistics
+        return statistics
 
     def draw_contours_on_image(self, image8bit):        
         """ Input: 
@@ -97,28 +633,19 @@ class ImageManager:
         displayed_image: RGB image with rectangle annotations
         """  
         
-        cx = self.cx
-        cy = self.cy 
         roisize = self.roisize
-        contours = self.contours
+        x = self.cx.astype(np.int32) - roisize//2
+        y = self.cy.astype(np.int32) - roisize//2
+        w = h = roisize
       
         displayed_image = cv2.cvtColor(image8bit,cv2.COLOR_GRAY2RGB)      
         
-        for indx, _val in enumerate(cx):       
-    
-            x = int(cx[indx] - roisize//2) 
-            y = int(cy[indx] - roisize//2)
-         
-            w = h = roisize
-            
-            displayed_image = cv2.drawContours(displayed_image, [contours[indx]], 0, (0,256,0), 2) 
-            
-            if indx == 0:
-                color = (256,0,0)
-            else: 
-                color = (0,0,256)
-                
-            cv2.rectangle(displayed_image,(x,y),(x+w,y+h),color,1)
+        # all the contours and all the rectangles are drawn with a single call
+        displayed_image = cv2.drawContours(displayed_image, self.contours, -1, (0,256,0), 2) 
+        corners = np.stack([np.stack([x, y], axis=1), np.stack([x+w, y], axis=1),
+                            np.stack([x+w, y+h], axis=1), np.stack([x, y+h], axis=1)], axis=1)
+        cv2.polylines(displayed_image, list(corners[1:]), True, (0,0,256), 1)
+        cv2.polylines(displayed_image, list(corners[:1]), True, (256,0,0), 1) # first object in red
             
         return displayed_image
     
@@ -144,12 +671,92 @@ class ImageManager:
             rois.append(detail)
                     
         return rois
+
+    def roi_origins(self, cx, cy):
+        """ Input: 
+        cx, cy: centroids of the rois
+            Output:
+        x, y: arrays with the top left corners of the rois.
+        Raises ValueError if a roi is not fully inside the frame
+        """
+        roisize = self.roisize
+        x = np.asarray(cx, dtype=int) - roisize//2
+        y = np.asarray(cy, dtype=int) - roisize//2
+        if np.any(x < 0) or np.any(y < 0) or np.any(x+roisize > self.dim_h) or np.any(y+roisize > self.dim_v):
+            raise ValueError('rois must be fully inside the frame')
+        return x, y
+
+    def extract_rois_batch(self, cx, cy):
+        """ Input: 
+        cx, cy: centroids of the rois
+            Output:
+        rois: contiguous array with shape (N, Nchannels, roisize, roisize),
+              with the rois of all the channels, gathered in a single fancy indexing operation
+        """
+        roisize = self.roisize
+        x, y = self.roi_origins(cx, cy)
+        windows = np.lib.stride_tricks.sliding_window_view(self.image, (roisize, roisize), axis=(1,2))
+        # windows has shape (Nchannels, dim_v-roisize+1, dim_h-roisize+1, roisize, roisize) and is a view of image
+        return np.moveaxis(windows, 0, 2)[y, x]
+
+    def roi_views(self, cx, cy):
+        """ Input: 
+        cx, cy: centroids of the rois
+            Output:
+        rois: list of views (no copy) of image, with shape (Nchannels, roisize, roisize).
+              They change when a new frame is written in image
+        """
+        roisize = self.roisize
+        x, y = self.roi_origins(cx, cy)
+        return [self.image[:, y0:y0+roisize, x0:x0+roisize] for x0, y0 in zip(x, y)]
    
     
     def highlight_channel(self,displayed_image):
         
-         cv2.rectangle(displayed_image,(0,0),(self.dim_h-1,self.dim_v-1),(255,255,0),3) 
-   
-            
-            
-        
\ No newline at end of file
+         cv2.rectangle(displayed_image,(0,0),(self.dim_h-1,self.dim_v-1),(255,255,0),3)
+
+
+
+class ImageBuffers:
+    '''
+    Triple buffering of ImageManager frames between the acquisition thread (single writer)
+    and the display (single reader), without locks and without copies.
+    The writer fills and processes the ImageManager returned by back() and then publishes it;
+    the reader gets the last published one with read(), which is not modified until the next read()
+    '''
+
+    def __init__(self, im, count=3):
+        self.buffers = [im] + [im.copy() for _ in range(max(count, 3)-1)]
+        self.front = im      # last published ImageManager
+        self.reading = None  # ImageManager in use by the reader
+
+    def back(self):
+        """
+        Returns a ImageManager that is neither published nor in use by the reader
+        """
+        front = self.front
+        reading = self.reading
+        for im in self.buffers:
+            if im is not front and im is not reading:
+                return im
+
+    def in_use(self, im):
+        """
+        True if im is published or in use by the reader
+        """
+        return im is self.front or im is self.reading
+
+    def publish(self, im):
+        # a reference assignment is atomic: the reader sees either the previous or the new frame
+        self.front = im
+
+    def read(self):
+        """
+        Returns the last published ImageManager, read only.
+        It is reserved before checking that it is still the published one, so that back() cannot return it
+        """
+        while True:
+            im = self.front
+            self.reading = im
+            if self.front is im:
+                return im
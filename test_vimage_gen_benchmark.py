@@ -0,0 +1,18 @@
+'''
+Checks of the benchmarks that assert the behavior of the virtual image generator.
+
+Run with:
+    python -m pytest test_vimage_gen_benchmark.py
+'''
+
+import pytest
+from vimage_gen_benchmark import bench_allocations, bench_detection
+
+
+@pytest.mark.parametrize('size', [512, 1024])
+def test_allocations(size):
+    bench_allocations(sizex=size, sizey=size, frames=20)
+
+
+def test_tiled_detection():
+    bench_detection(sizex=1024, sizey=1024, particles=(10, 100), tile_sizes=(512, 256, 100), repeats=1)
@@ -0,0 +1,261 @@
+'''
+Benchmarks for the virtual image generator.
+
+Run as a script:
+    python vimage_gen_benchmark.py
+'''
+
+import numpy as np
+import time
+import os
+import tempfile
+import tracemalloc
+import h5py
+from vimage_gen_device import VirtualImageGenDevice
+from image_data import ImageManager
+from vimage_gen_h5 import H5Flusher, ChunkWriter, H5Writer, dataset_options
+import vimage_gen_psf
+
+
+def bench_render(sizes=((512,256), (1024,1024), (2048,2048)),
+                 particles=(10, 50, 200),
+                 repeats=5):
+    """
+    Compares the full-grid, the patch-local and the sprite particle renderers.
+    The same particles are rendered by all the engines, so that the max absolute
+    difference from the full-grid (noise free, unit amplitude) image is reported too.
+    """
+    print(f'{"size":>11} {"particles":>9} {"full (ms)":>10} {"patch (ms)":>10} {"diff":>8}'
+          f' {"sprite (ms)":>11} {"diff":>8}')
+    for sizex, sizey in sizes:
+        device = VirtualImageGenDevice(sizex=sizex, sizey=sizey)
+        state = device.render_state
+        X, Y = state.get_grids()
+        engines = {'full': lambda z, X0, Y0, sigma: device.render_full(z, X, Y, X0, Y0, sigma),
+                   'patch': lambda z, X0, Y0, sigma: device.render_patch(z, state.x, state.y, X0, Y0, sigma, device.render_nsigma),
+                   'sprite': lambda z, X0, Y0, sigma: device.render_sprites(z, state.x, state.y, X0, Y0, sigma),
+                   }
+        for num in particles:
+            device.write_mean_particles(num)
+            times = dict.fromkeys(engines, 0.0)
+            diffs = dict.fromkeys(engines, 0.0)
+            for _ in range(repeats):
+                X0, Y0, sigma = device.draw_particles()
+                images = {}
+                for name, engine in engines.items():
+                    z = np.zeros((sizey, sizex))
+                    time0 = time.perf_counter()
+                    engine(z, X0, Y0, sigma)
+                    times[name] += (time.perf_counter() - time0)*1000/repeats
+                    images[name] = z
+                for name in engines:
+                    diffs[name] = max(diffs[name], np.nanmax(np.abs(images['full'] - images[name])))
+            print(f'{sizex:>5}x{sizey:<5} {num:>9} {times["full"]:>10.2f} {times["patch"]:>10.2f} {diffs["patch"]:>8.1e}'
+                  f' {times["sprite"]:>11.2f} {diffs["sprite"]:>8.1e}')
+
+
+def bench_synthesis(sizes=((1024,1024), (4096,4096)),
+                    workers=(0, 2, 4),
+                    mean_particles=50,
+                    frames=10):
+    """
+    Measures the frame rate of get_frame with in-process and multi-process synthesis
+    """
+    print(f'{"size":>11} {"workers":>7} {"fps":>8}')
+    for sizex, sizey in sizes:
+        for num in workers:
+            device = VirtualImageGenDevice(sizex=sizex, sizey=sizey,
+                                           mean_particles=mean_particles,
+                                           synthesis_workers=num)
+            device.get_frame() # warm up (creates buffers and worker processes)
+            time0 = time.perf_counter()
+            for _ in range(frames):
+                device.get_frame()
+            fps = frames/(time.perf_counter() - time0)
+            device.close()
+            print(f'{sizex:>5}x{sizey:<5} {num:>7} {fps:>8.1f}')
+
+
+def bench_allocations(sizex=1024, sizey=1024, frames=50, warmup=5,
+                      max_retained=1024, max_temporary=256*1024):
+    """
+    Checks with tracemalloc that get_frame(out=...) does not allocate per frame in steady state.
+    For each rendering mode, asserts that the memory retained after the frames
+    (the sprite cache excluded) is below max_retained bytes, i.e. does not grow
+    with the frames, and that the peak of the temporary allocations is below max_temporary bytes,
+    whatever the frame size and the number of particles.
+    In sprite mode each miss of the sprite cache allocates a sprite, so the frames are first
+    synthesized once with the same seed, to fill the cache with their sprites.
+    The remaining allocations are Python scalars, interpreter caches and the bounded buffers
+    of numpy's iteration and casting loops
+    """
+    frame_bytes = sizex*sizey*np.dtype(np.uint16).itemsize
+    excluded = [tracemalloc.Filter(False, vimage_gen_psf.__file__, all_frames=True), # sprite cache
+                tracemalloc.Filter(False, tracemalloc.__file__)]
+    print(f'{"mode":>16} {"retained (B)":>12} {"peak/frame":>10} {"misses":>7}')
+    for render_mode, particle_motion in (('patch', 'random'), ('sprite', 'random'),
+                                         ('full', 'random'), ('patch', 'brownian'),
+                                         ('sprite', 'brownian')):
+        device = VirtualImageGenDevice(sizex=sizex, sizey=sizey,
+                                       render_mode=render_mode,
+                                       particle_motion=particle_motion,
+                                       seed=0)
+        out = np.empty((sizey, sizex), dtype=np.uint16)
+        device.start_acquisition()
+        for _ in range(warmup+frames):
+            device.get_frame(out=out)
+        device.start_acquisition() # restarts the same particles
+        for _ in range(warmup):
+            device.get_frame(out=out)
+        misses0 = device.sprites.misses
+        tracemalloc.start(25)
+        snapshot0 = tracemalloc.take_snapshot().filter_traces(excluded)
+        current0, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(frames):
+            device.get_frame(out=out)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(excluded)
+        tracemalloc.stop()
+        device.stop_acquisition()
+        retained = sum(stat.size_diff for stat in snapshot.compare_to(snapshot0, 'lineno'))
+        name = render_mode + '/' + particle_motion
+        misses = device.sprites.misses - misses0
+        print(f'{name:>16} {retained:>12} {(peak-current0)/frame_bytes:>10.3f} {misses:>7}')
+        assert retained < max_retained, f'{name}: {retained} bytes retained after {frames} frames'
+        assert misses == 0, f'{name}: {misses} misses of the sprite cache'
+        assert peak-current0 < max_temporary, f'{name}: {peak-current0} bytes of temporaries'
+
+
+def bench_detection(sizex=2048, sizey=2048,
+                    particles=(10, 100, 1000),
+                    engines=('contours', 'components'),
+                    tile_sizes=(512, 256),
+                    repeats=5):
+    """
+    Compares the detection engines of ImageManager.find_object on synthetic frames
+    with an increasing number of particles, and the 'contours' engine on tiles of tile_sizes.
+    Asserts that the tiled detection finds the same objects and contours as the untiled one
+    """
+    print(f'{"particles":>9} {"engine":>12} {"time (ms)":>10} {"objects":>8}')
+    for num in particles:
+        device = VirtualImageGenDevice(sizex=sizex, sizey=sizey, mean_particles=num,
+                                       noise_amplitude=1000, signal_amplitude=20000, seed=0)
+        im = ImageManager(sizex, sizey, 30, min_object_area=20, max_object_area=4000, Nchannels=1)
+        device.get_channels(1, out=im.image)
+        runs = [(engine, 0) for engine in engines] + [('contours', tile) for tile in tile_sizes]
+        for engine, tile in runs:
+            im.engine = engine
+            im.tile_size = tile
+            name = engine if tile == 0 else f'tiles {tile}'
+            time0 = time.perf_counter()
+            for _ in range(repeats):
+                im.find_object(0)
+                im.contour_points # the contours are needed for the display
+            elapsed = (time.perf_counter() - time0)*1000/repeats
+            print(f'{num:>9} {name:>12} {elapsed:>10.2f} {len(im.objects):>8}')
+            if engine == 'contours' and tile == 0:
+                reference = im.objects.copy(), list(im.contours)
+            elif tile > 0:
+                objects, contours = reference
+                assert np.array_equal(im.objects, objects), f'{name}: objects differ from the untiled detection'
+                assert len(im.contours) == len(contours) and all(
+                    np.array_equal(a, b) for a, b in zip(im.contours, contours)), f'{name}: contours differ from the untiled detection'
+
+
+def bench_statistics(sizex=2048, sizey=2048,
+                     particles=(10, 100, 1000),
+                     channels=2,
+                     repeats=5):
+    """
+    Times ImageManager.compute_statistics (all objects and channels at once)
+    against a Python loop over the objects and channels (integrated and peak only)
+    """
+    print(f'{"particles":>9} {"objects":>8} {"vectorized (ms)":>16} {"loop (ms)":>10}')
+    for num in particles:
+        device = VirtualImageGenDevice(sizex=sizex, sizey=sizey, mean_particles=num,
+                                       noise_amplitude=1000, signal_amplitude=20000, seed=0)
+        im = ImageManager(sizex, sizey, 30, min_object_area=20, max_object_area=4000, Nchannels=channels)
+        device.get_channels(channels, out=im.image)
+        im.find_object(0)
+        time0 = time.perf_counter()
+        for _ in range(repeats):
+            im.compute_statistics()
+        vectorized = (time.perf_counter() - time0)*1000/repeats
+        time0 = time.perf_counter()
+        for _ in range(repeats):
+            label_image = im.object_label_image()
+            for indx in range(len(im.objects)):
+                mask = label_image == indx+1
+                for ch in range(channels):
+                    values = im.image[ch][mask]
+                    values.sum(), values.max()
+        loop = (time.perf_counter() - time0)*1000/repeats
+        print(f'{num:>9} {len(im.objects):>8} {vectorized:>16.2f} {loop:>10.2f}')
+
+
+def bench_flush(sizex=1024, sizey=1024,
+                frames=200,
+                rois_per_frame=20,
+                roisize=60,
+                channels=2,
+                compression='none',
+                policies=(('frames', 1), ('frames', 10), ('time', 1.0), ('close', None))):
+    """
+    Frames/s and MB/s of the h5 savers with each flush policy, written through H5Writer:
+    the stack path writes a frame per dataset row, as measure and save_stack,
+    the roi path appends the rois of each frame and their index to the resizable
+    'rois' and 'roi_index' datasets, as save_roi
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 4096, (sizey, sizex), dtype=np.uint16)
+    rois = rng.integers(0, 4096, (rois_per_frame, channels, roisize, roisize), dtype=np.uint16)
+    index_dtype = np.dtype([('frame', np.int64), ('id', np.int64), ('cx', np.int32), ('cy', np.int32)])
+    print(f'{"path":>6} {"policy":>12} {"frames/s":>9} {"MB/s":>8} {"flushes":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench_flush.h5')
+        for path in ('stack', 'roi'):
+            for policy, value in policies:
+                h5file = h5py.File(filename, 'w')
+                if path == 'stack':
+                    shape = (frames, sizey, sizex)
+                    h5file.create_dataset('stack', shape=shape, dtype=np.uint16,
+                                          **dataset_options(shape, compression=compression))
+                    nbytes = frames*frame.nbytes
+                else:
+                    shape = (0,) + rois.shape[1:]
+                    options = dataset_options(shape, compression=compression)
+                    options.setdefault('chunks', (1,) + shape[1:])
+                    h5file.create_dataset('rois', shape=shape, maxshape=(None,) + shape[1:], dtype=np.uint16, **options)
+                    h5file.create_dataset('roi_index', shape=(0,), maxshape=(None,), chunks=(1024,), dtype=index_dtype)
+                    nbytes = frames*rois.nbytes
+                writer = H5Writer(h5file,
+                                  flusher = H5Flusher(h5file, policy,
+                                                      flush_frames = value if policy == 'frames' else 1,
+                                                      flush_period = value if policy == 'time' else 1.0),
+                                  chunk_writer = ChunkWriter())
+                time0 = time.perf_counter()
+                for idx in range(frames):
+                    if path == 'stack':
+                        writer.write('stack', idx, frame)
+                    else:
+                        index = np.zeros(rois_per_frame, dtype=index_dtype)
+                        index['frame'] = idx
+                        index['id'] = np.arange(rois_per_frame)
+                        writer.append('rois', rois)
+                        writer.append('roi_index', index)
+                    writer.frame_done()
+                writer.close()
+                elapsed = time.perf_counter() - time0
+                name = policy if value is None else f'{policy} {value}'
+                print(f'{path:>6} {name:>12} {frames/elapsed:>9.1f} {nbytes/elapsed/2**20:>8.1f} {writer.flusher.flushes:>8}')
+
+
+if __name__ == '__main__':
+
+    bench_render()
+    bench_synthesis()
+    bench_allocations()
+    bench_detection()
+    bench_statistics()
+    bench_flush()
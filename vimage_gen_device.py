@@ -1,6 +1,228 @@
 import numpy as np
 import time
+import threading
+import functools
+from collections import deque
 import pyqtgraph as pg
+from vimage_gen_pool import SynthesisPool
+from vimage_gen_psf import PSFSpriteCache
+from vimage_gen_render import to_uint16, render_full, render_patch, render_sprites
+
+
+class RenderState(object):
+    """
+    Per-size data used by VirtualImageGenDevice to synthesize a frame:
+    pixel coordinates, coordinate grids and preallocated work buffers.
+    It is rebuilt by the device only when the frame size changes.
+    """
+
+    def __init__(self, sizex, sizey):
+        self.sizex = sizex
+        self.sizey = sizey
+        self.x = np.linspace(-sizex/2, sizex/2, sizex)
+        self.y = np.linspace(-sizey/2, sizey/2, sizey)
+        self.X = None # full grids, created only if needed by the full-grid renderer
+        self.Y = None
+        self.z = np.zeros((sizey, sizex), dtype=np.float32) # particles layer
+        self.img = np.zeros((sizey, sizex), dtype=np.float32) # noise + particles
+        self.layer = np.zeros((sizey, sizex), dtype=np.float32) # scratch layer (scaled particles or noise)
+        self.particles = None # persistent ParticleModel, if particles are moved across frames
+        self.frame = np.zeros((sizey, sizex), dtype=np.uint16)
+        self.pool_frame = None # frame synthesized by the synthesis pool, created at the first use
+        # work buffers of the patch renderer: profiles along x and y, and the patch of a particle
+        self.patch_work = (np.zeros(sizex, dtype=np.float32), np.zeros(sizey, dtype=np.float32),
+                           np.zeros((sizey, sizex), dtype=np.float32))
+        self.grid_work = None # work buffers of the full-grid renderer
+        self.centers = np.zeros((3, 0)) # centers and sigmas of the particles drawn for a frame
+
+    def get_grids(self):
+        if self.X is None:
+            self.X, self.Y = np.meshgrid(self.x, self.y)
+            self.grid_work = np.zeros((2, self.sizey, self.sizex))
+        return self.X, self.Y
+
+    def particle_buffer(self, size):
+        """
+        Returns a (3, N) buffer for the centers and sigmas of the particles, with N >= size
+        """
+        if self.centers.shape[1] < size:
+            self.centers = np.zeros((3, size))
+        return self.centers
+
+
+class ParticleModel(object):
+    """
+    Persistent particles, kept as arrays of positions, sigmas and amplitudes,
+    moved at every frame and rendered incrementally in the particles layer:
+    only the patches of the particles that moved are re-rendered.
+    """
+
+    def __init__(self, X0, Y0, sigma, amplitude=None):
+        self.ids = np.arange(len(X0))
+        self.x = np.array(X0, dtype=float)
+        self.y = np.array(Y0, dtype=float)
+        self.sigma = np.abs(sigma)
+        self.amplitude = np.ones(len(X0)) if amplitude is None else np.asarray(amplitude, dtype=float)
+        self.rendered = None # (x, y) of the particles as rendered in the particles layer
+        self.renders = 0 # incremental renders since the last full render
+        self.step = np.zeros(len(X0)) # work buffer of the random steps
+
+    def move(self, motion, step, rng, sizex, sizey):
+        """
+        Moves all the particles by a Brownian step of standard deviation step ('brownian')
+        or by step along x ('flow'). Particles leaving the frame re-enter from the opposite side.
+        """
+        if motion == 'brownian':
+            for coord in (self.x, self.y):
+                rng.standard_normal(out=self.step)
+                self.step *= step
+                coord += self.step
+        elif motion == 'flow':
+            self.x += step
+        for coord, size in ((self.x, sizex), (self.y, sizey)):
+            coord += size/2
+            np.mod(coord, size, out=coord)
+            coord -= size/2
+
+    def render(self, z, draw, area, refresh=100):
+        """
+        Updates the particles layer z. draw(z, X0, Y0, sigma, amplitude) adds particles to z
+        (the renderer of the device render mode), area is the number of pixels it draws for each particle.
+        Only the particles that moved since the last render are re-rendered, erased at the old position
+        and drawn at the new one.
+        The whole layer is re-rendered instead at the first call, when erasing and drawing the moved particles
+        costs more than clearing the layer and drawing all of them, and every refresh calls,
+        to clear the rounding errors of the incremental updates
+        """
+        moved = None
+        if self.rendered is not None and self.renders < refresh:
+            rx, ry = self.rendered
+            moved = (rx != self.x) | (ry != self.y)
+            if 2*area[moved].sum() > z.size + area.sum():
+                moved = None
+        if moved is None:
+            z.fill(0)
+            draw(z, self.x, self.y, self.sigma, self.amplitude)
+            self.renders = 0
+        else:
+            sigma = self.sigma[moved]
+            amplitude = self.amplitude[moved]
+            draw(z, rx[moved], ry[moved], sigma, -amplitude)
+            draw(z, self.x[moved], self.y[moved], sigma, amplitude)
+            self.renders += 1
+        if self.rendered is None:
+            self.rendered = (self.x.copy(), self.y.copy())
+        else:
+            np.copyto(self.rendered[0], self.x)
+            np.copyto(self.rendered[1], self.y)
+
+
+class FrameClock(object):
+    """
+    Monotonic clock scheduler emitting frames on a fixed cadence:
+    frame n is emitted at the end of its period, at t0 + (n+1)*period.
+    A period <= 0 means free run.
+    Frames emitted before they are requested are dropped, the latest one is returned.
+    """
+
+    def __init__(self, period=0.0):
+        self.period = period
+        self.number = -1 # sequence number of the last emitted frame
+        self.dropped = 0
+        self.t0 = time.monotonic()
+
+    def set_period(self, period):
+        """
+        Changes the period, restarting the cadence from the last emitted frame
+        """
+        self.period = period
+        self.t0 = time.monotonic() - (self.number+1)*period
+
+    def wait_next(self):
+        """
+        Waits for the emission of the next frame and returns its sequence number and timestamp
+        """
+        number = self.number + 1
+        if self.period <= 0:
+            self.number = number
+            return number, time.monotonic()
+        t_emit = self.t0 + (number+1)*self.period
+        now = time.monotonic()
+        if now < t_emit:
+            time.sleep(t_emit - now)
+        else:
+            latest = max(int((now - self.t0)/self.period) - 1, number)
+            self.dropped += latest - number
+            number = latest
+            t_emit = self.t0 + (number+1)*self.period
+        self.number = number
+        return number, t_emit
+
+
+class FrameRing(object):
+    """
+    Ring of N preallocated frame buffers, filled by a producer thread
+    and emptied by the consumer (get_frame).
+    When the ring is full the producer overwrites the oldest ready frame (overrun),
+    when it is empty the consumer waits for the next frame (underrun).
+    The buffer being copied by the consumer is never overwritten, so at least 2 buffers are needed.
+    """
+
+    def __init__(self, size, shape, dtype=np.uint16):
+        if size < 2:
+            raise ValueError(f'FrameRing needs at least 2 buffers, got {size}')
+        self.buffers = np.zeros((size,)+tuple(shape), dtype=dtype)
+        self.numbers = np.zeros(size, dtype=np.int64) # sequence number of the frame in each buffer
+        self.timestamps = np.zeros(size)
+        self.free = deque(range(size))   # indices of the buffers that can be filled
+        self.ready = deque()             # indices of the filled buffers, oldest first
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.overruns = 0
+        self.underruns = 0
+
+    def acquire_free(self):
+        """
+        Returns the index of a buffer to fill, or None if the ring was stopped
+        """
+        with self.cond:
+            if not self.free and self.ready:
+                self.overruns += 1
+                return self.ready.popleft()
+            self.cond.wait_for(lambda: self.free or self.stopped) # the consumer is copying the only other buffer
+            if not self.free:
+                return None
+            return self.free.popleft()
+
+    def publish(self, idx):
+        with self.cond:
+            self.ready.append(idx)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def get(self, out):
+        """
+        Copies the oldest ready frame in out and returns its sequence number and timestamp,
+        or None if the ring was stopped
+        """
+        with self.cond:
+            if not self.ready:
+                self.underruns += 1
+                self.cond.wait_for(lambda: self.ready or self.stopped)
+                if not self.ready:
+                    return None
+            idx = self.ready.popleft()
+        np.copyto(out, self.buffers[idx])
+        info = self.numbers[idx], self.timestamps[idx]
+        with self.cond:
+            self.free.append(idx)
+            self.cond.notify_all()
+        return info
+
 
 class VirtualImageGenDevice(object):
     """
@@ -14,7 +236,18 @@ class VirtualImageGenDevice(object):
                  signal_amplitude = 200.0,
                  mean_particles = 10,
                  sizex = 512,
-                 sizey = 256):
+                 sizey = 256,
+                 render_mode = 'patch',
+                 render_nsigma = 5.0,
+                 prefetch = False,
+                 ring_size = 4,
+                 synthesis_workers = 0,
+                 seed = None,
+                 exposure_time = 0.0,
+                 frame_rate = 0.0,
+                 channel_gains = (1.0, 0.5),
+                 particle_motion = 'random',
+                 particle_step = 1.0):
         """We would connect to the real-world here
         if this were a real device
         """
@@ -23,7 +256,29 @@ class VirtualImageGenDevice(object):
         self.mean_particles = mean_particles
         self.sizex = sizex
         self.sizey = sizey
+        self.render_mode = render_mode # 'patch', 'sprite' or 'full'
+        self.render_nsigma = render_nsigma # half size of the particle window, in sigmas
+        self.sprites = PSFSpriteCache(nsigma=render_nsigma)
+        self.prefetch = prefetch # synthesize frames in a background thread during acquisition
+        self.ring_size = ring_size
+        self.synthesis_workers = synthesis_workers # worker processes used to synthesize the frames, 0 for in-process synthesis
+        self.seed = seed # seed of the random streams, None (or negative) for a non reproducible sequence
+        self.exposure_time = exposure_time # s
+        self.frame_rate = frame_rate # frames per second, 0 for free run (limited by the exposure time only)
+        self.channel_gains = channel_gains # relative signal amplitude of each channel, in multichannel acquisition
+        self.particle_motion = particle_motion # 'random' (new particles at each frame), 'brownian' or 'flow'
+        self.particle_step = particle_step # Brownian step standard deviation, or flow speed, in pixels per frame
         self.frame_idx = 0
+        self.frame_number = -1 # sequence number of the last acquired frame
+        self.frame_timestamp = 0.0 # emission time of the last acquired frame, in the time.monotonic() clock
+        self._render_state = None
+        self._pool = None
+        self._lock = threading.RLock() # frame index, random streams, particles and sprites are shared with the producer thread
+        self._clock = FrameClock(self.frame_period)
+        self.reset_rng()
+        self._ring = None
+        self._producer = None
+        self._producer_state = None # render state of the producer thread
 
     def write_signal_amp(self, amplitude):
         """
@@ -43,10 +298,16 @@ class VirtualImageGenDevice(object):
         self.noise_amplitude = amplitude
         
     def write_sizex(self, sizex):
-        self.sizex = sizex 
+        with self._lock:
+            self.sizex = sizex 
+            self.invalidate_render_state()
+            self.close_synthesis_pool()
 
     def write_sizey(self, sizey):
-        self.sizey = sizey
+        with self._lock:
+            self.sizey = sizey
+            self.invalidate_render_state()
+            self.close_synthesis_pool()
 
 
     def write_mean_particles(self, mean_particles):
@@ -56,39 +317,428 @@ class VirtualImageGenDevice(object):
         a setting on the device
         """
         self.mean_particles = mean_particles    
+        self.reset_particles()
+
+    def write_particle_motion(self, particle_motion):
+        self.particle_motion = particle_motion
+        self.reset_particles()
+
+    def write_particle_step(self, particle_step):
+        self.particle_step = particle_step
+
+    def reset_particles(self):
+        """
+        Drops the persistent particles, new ones are drawn at the next frame
+        """
+        with self._lock:
+            for state in (self._render_state, self._producer_state):
+                if state is not None:
+                    state.particles = None
+
+    def read_particles(self):
+        """
+        Ground truth of the persistent particles (particle_motion 'brownian' or 'flow') at the last
+        synthesized frame: copies of their ids, centers (x, y, in the frame coordinates) and sigmas,
+        or None if there are none. With prefetch, the last synthesized frame can be ahead of the last acquired one
+        """
+        with self._lock:
+            state = self._producer_state if self._producer is not None else self._render_state
+            if state is None or state.particles is None:
+                return None
+            particles = state.particles
+            return particles.ids.copy(), particles.x.copy(), particles.y.copy(), particles.sigma.copy()
+
+    def write_render_mode(self, render_mode):
+        self.render_mode = render_mode
+
+    def write_psf(self, psf):
+        """
+        Sets the function used to render the sprites of the particles,
+        with the signature of vimage_gen_psf.gaussian_psf 
+        """
+        with self._lock:
+            self.sprites.psf = psf
+            self.sprites.clear()
+
+    def write_prefetch(self, prefetch):
+        """
+        Enables the background frame producer. Takes effect at the next start_acquisition
+        """
+        self.prefetch = prefetch
+
+    def write_ring_size(self, ring_size):
+        self.ring_size = ring_size
+
+    def write_seed(self, seed):
+        self.seed = seed
+        self.reset_rng()
+
+    def reset_rng(self):
+        """
+        Restarts the random streams from the seed.
+        Particles placement, noise and the noise of the synthesis pool workers
+        use independent child streams of the same SeedSequence
+        """
+        if self.seed is None or self.seed < 0:
+            seed_seq = np.random.SeedSequence()
+        else:
+            seed_seq = np.random.SeedSequence(self.seed)
+        particles_seq, noise_seq, pool_seq = seed_seq.spawn(3)
+        with self._lock:
+            self._pool_seq = pool_seq
+            self.rng_particles = np.random.Generator(np.random.PCG64(particles_seq))
+            self.rng_noise = np.random.Generator(np.random.PCG64(noise_seq))
+
+    def write_synthesis_workers(self, synthesis_workers):
+        with self._lock:
+            self.synthesis_workers = synthesis_workers
+            self.close_synthesis_pool()
 
-    def start_acquisition(self):
+    @property
+    def frame_period(self):
+        period = 1.0/self.frame_rate if self.frame_rate > 0 else 0.0
+        return max(period, self.exposure_time)
+
+    def write_exposure_time(self, exposure_time):
+        self.exposure_time = exposure_time
+        self._clock.set_period(self.frame_period)
+
+    def write_frame_rate(self, frame_rate):
+        self.frame_rate = frame_rate
+        self._clock.set_period(self.frame_period)
+
+    def write_channel_gains(self, channel_gains):
+        self.channel_gains = channel_gains
+
+    def read_dropped_frames(self):
+        """
+        Frames emitted by the camera and never returned by get_frame
+        """
+        dropped = self._clock.dropped
+        if self._ring is not None:
+            dropped += self._ring.overruns
+        return dropped
+
+    def read_overruns(self):
+        return self._ring.overruns if self._ring is not None else 0
+
+    def read_underruns(self):
+        return self._ring.underruns if self._ring is not None else 0
+
+    def start_acquisition(self, channels=None):
+        """
+        Starts the acquisition. If channels is specified, the prefetch ring 
+        is filled with (channels, sizey, sizex) channel sets, to be read with get_channels
+        """
+        self.stop_acquisition()
         self.frame_idx = 0
-        pass
+        self.reset_rng()
+        self.reset_particles()
+        self._clock = FrameClock(self.frame_period)
+        if self.prefetch:
+            state = RenderState(self.sizex, self.sizey) # the producer has its own work buffers
+            shape = (state.sizey, state.sizex) if channels is None else (channels, state.sizey, state.sizex)
+            self._ring = FrameRing(self.ring_size, shape)
+            self._producer_state = state
+            self._producer = threading.Thread(target=self._produce_frames,
+                                              args=(self._ring, state, self._clock),
+                                              daemon=True)
+            self._producer.start()
 
     def stop_acquisition(self):
+        if self._producer is not None:
+            self._ring.stop()
+            self._producer.join()
+            self._producer = None
+            self._producer_state = None
         self.frame_idx = 0
-        pass
+
+    def _produce_frames(self, ring, state, clock):
+        try:
+            while not ring.stopped:
+                idx = ring.acquire_free()
+                if idx is None:
+                    break
+                if ring.buffers.ndim == 4:
+                    self.render_channels(ring.buffers[idx], state)
+                else:
+                    to_uint16(self.render(state), ring.buffers[idx])
+                ring.numbers[idx], ring.timestamps[idx] = clock.wait_next()
+                ring.publish(idx)
+        finally:
+            ring.stop()
            
-    def get_frame(self):
-        
-        noise = np.random.rand(self.sizey, self.sizex) * self.noise_amplitude
-        x = np.linspace(-self.sizex/2, self.sizex/2, self.sizex)
-        y = np.linspace(-self.sizey/2, self.sizey/2, self.sizey)
-        X, Y = np.meshgrid(x, y)
-        # 2D Gaussian
-        z = np.zeros((self.sizey, self.sizex))
-        for _ in range(np.random.randint(self.mean_particles//2, self.mean_particles*3//2)):
-            X0 = np.random.normal(scale=self.sizex/8.0)
-            Y0 = np.random.normal(scale=self.sizey/8.0)
-            sigma = np.random.normal(loc=self.sizex/128.0, scale=self.sizex/128.0)                
-            z += np.exp(-((X-X0)**2 + (Y-Y0)**2) / (2*sigma**2))
-        if self.frame_idx%2==0:
-            img = z *self.signal_amplitude + noise + 1
-        elif self.frame_idx%2==1:
-            img = noise + 1
+    @property
+    def render_state(self):
+        """
+        Render state cache, rebuilt only after a change of the frame size
+        """
+        if self._render_state is None:
+            self._render_state = RenderState(self.sizex, self.sizey)
+        return self._render_state
+
+    def invalidate_render_state(self):
+        self._render_state = None
+
+    def get_synthesis_pool(self, state, channels=1):
+        """
+        Process pool used when synthesis_workers > 0 to synthesize the frames of the render state,
+        created at the first use and recreated when the frame size or the number of channels changes.
+        The pool must be used holding the device lock, as it is closed under it
+        """
+        with self._lock:
+            if self._pool is not None and (self._pool.channels, self._pool.sizex, self._pool.sizey) != (channels, state.sizex, state.sizey):
+                self.close_synthesis_pool()
+            if self._pool is None:
+                self._pool = SynthesisPool(self.synthesis_workers, state.sizex, state.sizey, channels)
+            return self._pool
+
+    def close_synthesis_pool(self):
+        """
+        Closes the synthesis pool, waiting for the frame being synthesized in it
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+    def close(self):
+        self.stop_acquisition()
+        self.close_synthesis_pool()
+
+    def render(self, state=None):
+        """
+        Synthesizes a frame and returns it. 
+        The returned array is a work buffer of the render state (float, or uint16
+        with the synthesis pool) overwritten by the next call.
+        """
+        with self._lock:
+            if state is None:
+                state = self.render_state
+            if self.synthesis_workers > 0:
+                # copied out of the shared memory, that is released when the pool is closed
+                if state.pool_frame is None:
+                    state.pool_frame = np.zeros((state.sizey, state.sizex), dtype=np.uint16)
+                np.copyto(state.pool_frame, self._render_pool(state)[0])
+                return state.pool_frame
+            img = state.img
+            self.rng_noise.random(dtype=np.float32, out=img)
+            img *= self.noise_amplitude
+            img += 1
+            if self.frame_idx%2==0:
+                z = self._render_particles(state)
+                np.multiply(z, self.signal_amplitude, out=state.layer, casting='same_kind')
+                img += state.layer
+            elif self.particle_motion != 'random':
+                self._next_particles(state) # persistent particles move also in the background frames, without drawing
+            self.frame_idx += 1
+        return img
+
+    def render_channels(self, out, state=None):
+        """
+        Synthesizes a set of channels into out, a (channels, sizey, sizex) uint16 array.
+        All the channels share the same particles, with the signal amplitude
+        scaled by channel_gains, and have independent noise
+        """
+        with self._lock:
+            if state is None:
+                state = self.render_state
+            if self.synthesis_workers > 0:
+                np.copyto(out, self._render_pool(state, out.shape[0]))
+                return out
+            z = self._render_particles(state)
+            img = state.img
+            noise = state.layer
+            for ch in range(out.shape[0]):
+                np.multiply(z, self.channel_gain(ch)*self.signal_amplitude, out=img, casting='same_kind')
+                self.rng_noise.random(dtype=np.float32, out=noise)
+                noise *= self.noise_amplitude
+                img += noise
+                img += 1
+                to_uint16(img, out[ch])
+            self.frame_idx += 1
+        return out
+
+    def channel_gain(self, channel):
+        return self.channel_gains[channel] if channel < len(self.channel_gains) else 1.0
+
+    def _next_particles(self, state):
+        """
+        Returns the particles of the next frame, X0, Y0 and sigma: new particles with particle_motion 'random',
+        otherwise the persistent particles of the render state, after a move
+        """
+        if self.particle_motion == 'random':
+            return self.draw_particles(state.sizex, state.sizey,
+                                       out=state.particle_buffer(self.mean_particles*3//2))
+        if state.particles is None:
+            state.particles = ParticleModel(*self.draw_particles(state.sizex, state.sizey))
+        else:
+            state.particles.move(self.particle_motion, self.particle_step, self.rng_particles,
+                                 state.sizex, state.sizey)
+        return state.particles.x, state.particles.y, state.particles.sigma
+
+    def _render_particles(self, state):
+        """
+        Renders the particles (2D Gaussians, unit amplitude) in the particles layer of the render state
+        and returns it. With particle_motion 'random' new particles are drawn,
+        otherwise the persistent particles are moved and rendered incrementally
+        """
+        z = state.z
+        X0, Y0, sigma = self._next_particles(state)
+        if self.particle_motion != 'random':
+            state.particles.render(z, functools.partial(self._add_particles, state),
+                                   self._particle_area(state, sigma))
+            return z
+        z.fill(0)
+        self._add_particles(state, z, X0, Y0, sigma)
+        return z
+
+    def _particle_area(self, state, sigma):
+        """
+        Number of pixels drawn for each particle by the renderer of render_mode
+        """
+        size = state.sizex*state.sizey
+        if self.render_mode == 'full':
+            return np.full(len(sigma), size)
+        side = 2*self.render_nsigma*np.abs(sigma)/(state.x[1]-state.x[0]) + 1
+        return np.minimum(side*side, size)
+
+    def _add_particles(self, state, z, X0, Y0, sigma, amplitude=None):
+        """
+        Adds the particles to z, with the renderer of render_mode and the work buffers of the render state
+        """
+        if self.render_mode == 'full':
+            X, Y = state.get_grids()
+            self.render_full(z, X, Y, X0, Y0, sigma, amplitude, work=state.grid_work)
+        elif self.render_mode == 'sprite':
+            render_sprites(z, state.x, state.y, X0, Y0, sigma, self.sprites, amplitude)
+        else:
+            self.render_patch(z, state.x, state.y, X0, Y0, sigma, self.render_nsigma, amplitude, work=state.patch_work)
+           
+    def _render_pool(self, state, channels=None):
+        """
+        Synthesizes a frame, or a set of channels, with the synthesis pool
+        and returns the (channels, sizey, sizex) uint16 frames in its shared memory
+        """
+        particles = None
+        if channels is None:
+            if self.frame_idx%2==0 or self.particle_motion != 'random':
+                particles = self._next_particles(state) # persistent particles move also in the background frames
+            if self.frame_idx%2!=0:
+                particles = None
+            signal_amplitudes = [self.signal_amplitude]
+        else:
+            particles = self._next_particles(state)
+            signal_amplitudes = [self.channel_gain(ch)*self.signal_amplitude for ch in range(channels)]
         self.frame_idx += 1
-        return np.uint16(img)
-    
+        seeds = self._pool_seq.spawn(self.synthesis_workers)
+        pool = self.get_synthesis_pool(state, len(signal_amplitudes))
+        return pool.render(seeds, self.noise_amplitude, signal_amplitudes, particles,
+                           self.render_mode, self.sprites.nsigma, self.sprites.psf)
+
+    def _acquire(self, out):
+        """
+        Acquires the next frame into out, from the prefetch ring if running,
+        and records its sequence number and timestamp
+        """
+        info = None
+        if self._producer is not None and self._ring.buffers.shape[1:] == out.shape:
+            info = self._ring.get(out)
+        if info is None:
+            if out.ndim == 3:
+                self.render_channels(out)
+            else:
+                to_uint16(self.render(), out)
+            info = self._clock.wait_next()
+        self.frame_number, self.frame_timestamp = info
+        return info
+
+    def get_frame(self, out=None):
+        """
+        Returns the next frame, as a (sizey, sizex) uint16 array.
+        If out is specified, the frame is written in it and out is returned:
+        in steady state no memory is allocated for the frame.
+        Its sequence number and timestamp are stored in frame_number and frame_timestamp
+        """
+        if out is None:
+            out = np.empty((self.sizey, self.sizex), dtype=np.uint16)
+        self._acquire(out)
+        return out
+
+    def get_channels(self, channels, out=None):
+        """
+        Acquires a set of channels (sharing the same particles) into a (channels, sizey, sizex) uint16 array.
+        If out is specified, the channels are written in it and out is returned.
+        Its sequence number and timestamp are stored in frame_number and frame_timestamp
+        """
+        if out is None:
+            out = np.empty((channels, self.sizey, self.sizex), dtype=np.uint16)
+        self._acquire(out)
+        return out
+
+    def get_frames(self, n, out=None, interrupted=None):
+        """
+        Acquires n consecutive frames into a single contiguous (n, sizey, sizex) uint16 array.
+        The frames are still synthesized one at a time, each directly in its slot of the stack.
+        If out is specified, the frames are written in it and out is returned.
+        interrupted, if specified, is called before each frame: when it returns True
+        the acquisition stops and only the frames acquired so far are returned.
+        Sequence numbers and timestamps of the frames are stored in frame_numbers and frame_timestamps
+        """
+        if out is None:
+            out = np.empty((n, self.sizey, self.sizex), dtype=np.uint16)
+        self.frame_numbers = np.zeros(n, dtype=np.int64)
+        self.frame_timestamps = np.zeros(n)
+        for idx in range(n):
+            if interrupted is not None and interrupted():
+                self.frame_numbers = self.frame_numbers[:idx]
+                self.frame_timestamps = self.frame_timestamps[:idx]
+                return out[:idx]
+            self.frame_numbers[idx], self.frame_timestamps[idx] = self._acquire(out[idx])
+        return out
+
+    def draw_particles(self, sizex=None, sizey=None, out=None):
+        """
+        Draws a random number of particles around the frame center.
+        Returns the arrays X0, Y0 (centers, in the frame coordinates) and sigma.
+        If out, a (3, N) array, is specified and large enough, the arrays are views of its rows
+        """
+        if sizex is None:
+            sizex = self.sizex
+        if sizey is None:
+            sizey = self.sizey
+        rng = self.rng_particles
+        num = rng.integers(self.mean_particles//2, self.mean_particles*3//2)
+        if out is None or out.shape[1] < num:
+            out = np.zeros((3, num))
+        X0, Y0, sigma = out[:, :num]
+        # same values as rng.normal(loc, scale, num), without temporaries
+        rng.standard_normal(out=X0)
+        X0 *= sizex/8.0
+        rng.standard_normal(out=Y0)
+        Y0 *= sizey/8.0
+        rng.standard_normal(out=sigma)
+        sigma *= sizex/128.0
+        sigma += sizex/128.0
+        return X0, Y0, sigma
+
+    render_full = staticmethod(render_full)
+    render_patch = staticmethod(render_patch)
+
+    def render_sprites(self, z, x, y, X0, Y0, sigma, amplitude=None):
+        render_sprites(z, x, y, X0, Y0, sigma, self.sprites, amplitude)
+
     def store_frame(self):
-        self._frame = self.get_frame()
+        """
+        Acquires a frame into the uint16 frame buffer preallocated in the render state
+        """
+        self._frame = self.get_frame(out=self.render_state.frame)
     
     def get_stored_frame(self):
+        """
+        Returns the stored frame buffer itself, not a copy: it is overwritten by the next store_frame,
+        so callers that keep the frame across store_frame calls must copy it
+        """
         return(self._frame)
     
 if __name__ == '__main__':
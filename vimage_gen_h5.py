@@ -0,0 +1,286 @@
+'''
+HDF5 saving helpers shared by the measurements.
+
+H5Flusher applies the flush policy of a h5 file:
+'frames' flushes every flush_frames written frames,
+'time' every flush_period seconds from a background thread,
+'close' only when the file is closed.
+
+dataset_options gives the layout of the image datasets (chunking and compression),
+ChunkWriter writes frames in them, compressing the gzip chunks in a thread pool
+and storing them with direct chunk writes.
+
+H5Writer owns the h5 file of a measurement and writes the frames in a background thread,
+so that the acquisition does not wait for the disk.
+
+H5Settings adds the saving settings to a measurement and creates its H5Writer and datasets from them.
+'''
+
+import numpy as np
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from vimage_gen_pipeline import StageQueue
+
+
+class H5Flusher(object):
+    """
+    Flushes h5file according to policy. The savers call frame_written after writing frames,
+    and close before closing the file
+    """
+
+    def __init__(self, h5file, policy='frames', flush_frames=1, flush_period=1.0):
+        if policy not in ('frames', 'time', 'close'):
+            raise ValueError(f'Unknown flush policy {policy}')
+        self.h5file = h5file
+        self.policy = policy
+        self.flush_frames = flush_frames
+        self.flush_period = flush_period
+        self.frames = 0     # frames written since the last flush
+        self.flushes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        if policy == 'time':
+            self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._thread.start()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_period):
+            self.flush()
+
+    def flush(self):
+        self.h5file.flush()
+        self.frames = 0
+        self.flushes += 1
+
+    def flush_due(self, frames=1):
+        """
+        True if frame_written(frames) flushes the file
+        """
+        return self.policy == 'frames' and self.frames + frames >= self.flush_frames
+
+    def frame_written(self, frames=1):
+        self.frames += frames
+        if self.policy == 'frames' and self.frames >= self.flush_frames:
+            self.flush()
+
+    def close(self):
+        """
+        Stops the background flusher and flushes the frames written since the last flush
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.h5file.id.valid:
+            self.flush()
+
+
+def dataset_options(shape, chunking='frame', compression='none', compression_level=4):
+    """
+    Keyword arguments of create_dataset for a (frames, height, width) dataset.
+    chunking: 'frame' for a chunk per frame, 'none' for a contiguous dataset
+    compression: 'none', 'gzip' or 'lzf', always with byte shuffle (that needs chunks)
+    """
+    options = {}
+    if chunking == 'frame' or compression != 'none':
+        options['chunks'] = (1,) + tuple(shape[1:])
+    if compression != 'none':
+        options['compression'] = compression
+        options['shuffle'] = True
+        if compression == 'gzip':
+            options['compression_opts'] = compression_level
+    return options
+
+
+class ChunkWriter(object):
+    """
+    Writes stacks of frames in the datasets.
+    In gzip datasets with a chunk per frame, each frame is shuffled and compressed by a pool of workers
+    (zlib releases the GIL) and written with write_direct_chunk, so write() returns before the compression.
+    The frames must not be modified until they are written (wait or close).
+    At most max_pending frames are compressed at the same time, then write() waits.
+    Other datasets are written directly
+    """
+
+    def __init__(self, workers=2, max_pending=16):
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def direct_chunks(dataset):
+        return (dataset.compression == 'gzip' and dataset.shuffle and not dataset.fletcher32
+                and dataset.scaleoffset is None and dataset.chunks == (1,) + dataset.shape[1:])
+
+    def write(self, dataset, frames, start=0):
+        """
+        Writes frames (frames, height, width) in dataset[start:start+len(frames)]
+        """
+        if not self.direct_chunks(dataset):
+            dataset[start:start+len(frames)] = frames
+            return
+        level = dataset.compression_opts
+        for idx, frame in enumerate(frames):
+            self.pending.acquire()
+            future = self.executor.submit(self._write_chunk, dataset, start+idx, frame, level)
+            with self.lock:
+                self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+                self.futures.append(future)
+
+    def _write_chunk(self, dataset, index, frame, level):
+        try:
+            data = np.ascontiguousarray(frame, dtype=dataset.dtype)
+            # byte shuffle: all the first bytes of the values, then all the second bytes, ...
+            shuffled = data.view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+            dataset.id.write_direct_chunk((index,) + (0,)*(dataset.ndim-1), zlib.compress(shuffled, level))
+        finally:
+            self.pending.release()
+
+    def wait(self):
+        """
+        Waits for the frames being compressed and raises the error of a failed write
+        """
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+
+class H5Writer(object):
+    """
+    Asynchronous writer of h5file. write(key, index, array) queues the array (no copy) for
+    h5file[key][index:index+len(array)], or h5file[key][index] for a single frame, and returns;
+    append(key, array) queues the array for the end of the resizable dataset h5file[key], that the writer thread
+    extends along the first axis; a writer thread writes the queued arrays in order, through chunk_writer, and
+    frame_done(frames) tells the flusher that the frames queued so far are complete.
+    The arrays must not be modified after write.
+    When the queue of queue_size writes is full, write waits.
+    The compression is waited for only before a flush and at close.
+    close() writes all the queued arrays and closes the file, writes after close raise ValueError
+    """
+
+    def __init__(self, h5file, flusher=None, chunk_writer=None, queue_size=16):
+        self.h5file = h5file
+        self.flusher = flusher if flusher is not None else H5Flusher(h5file, 'close')
+        self.chunk_writer = chunk_writer if chunk_writer is not None else ChunkWriter(1)
+        self.queue = StageQueue(queue_size, 'block')
+        self.datasets = {}
+        self.writes = 0
+        self.latency = 0.0       # time from write to the end of the write in h5file, of the last write
+        self.max_latency = 0.0
+        self.error = None
+        self._thread = threading.Thread(target=self._write_queued, daemon=True)
+        self._thread.start()
+
+    @property
+    def high_water(self):
+        # maximum number of writes waiting in the queue
+        return self.queue.high_water
+
+    def write(self, key, index, array):
+        if self.error is not None:
+            raise self.error
+        if self.queue.stopped:
+            raise ValueError('write on a closed H5Writer')
+        self.queue.put((key, index, array, time.perf_counter()))
+
+    def append(self, key, array):
+        self.write(key, None, array)
+
+    def frame_done(self, frames=1):
+        self.write(None, None, frames)
+
+    def _write_queued(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            key, index, array, time0 = entry
+            if self.error is not None:
+                continue # after an error the queue is only drained
+            try:
+                if key is None:
+                    if self.flusher.flush_due(array):
+                        self.chunk_writer.wait() # the flushed frames must be complete
+                    self.flusher.frame_written(array)
+                    continue
+                dataset = self.datasets.get(key)
+                if dataset is None:
+                    dataset = self.datasets[key] = self.h5file[key]
+                if array.ndim < dataset.ndim:
+                    array = array[np.newaxis]
+                if index is None:
+                    index = dataset.shape[0]
+                    dataset.resize(index+len(array), axis=0)
+                self.chunk_writer.write(dataset, array, start=index)
+                self.writes += 1
+                self.latency = time.perf_counter() - time0
+                self.max_latency = max(self.max_latency, self.latency)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        """
+        Writes the queued arrays, waits for the compression, flushes and closes the file.
+        Raises the error of a failed write
+        """
+        self.queue.stop() # no more writes are accepted, the queued ones are still written
+        self._thread.join()
+        try:
+            self.chunk_writer.close()
+            self.flusher.close()
+        finally:
+            self.h5file.close()
+        if self.error is not None:
+            raise self.error
+
+
+class H5Settings(object):
+    """
+    Saving settings of a measurement:
+    flush_policy, flush_frames and flush_period of the H5Flusher,
+    chunking, compression and compression_level of the datasets (see dataset_options),
+    compression_workers of the ChunkWriter, write_queue_size of the H5Writer and, read only,
+    write_latency (ms, from the write request to the end of the write) and write_queue_high_water
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        settings.New('flush_policy', dtype=str, initial='frames', choices=['frames', 'time', 'close'])
+        settings.New('flush_frames', dtype=int, initial=1, vmin=1)
+        settings.New('flush_period', dtype=float, unit='s', initial=1.0, vmin=0.01)
+        settings.New('chunking', dtype=str, initial='frame', choices=['frame', 'none'])
+        settings.New('compression', dtype=str, initial='none', choices=['none', 'gzip', 'lzf'])
+        settings.New('compression_level', dtype=int, initial=4, vmin=0, vmax=9)
+        settings.New('compression_workers', dtype=int, initial=2, vmin=1)
+        settings.New('write_queue_size', dtype=int, initial=16, vmin=1)
+        settings.New('write_latency', dtype=float, unit='ms', initial=0.0, ro=True)
+        settings.New('write_queue_high_water', dtype=int, initial=0, ro=True)
+
+    def create_writer(self, h5file):
+        return H5Writer(h5file,
+                        flusher = H5Flusher(h5file,
+                                            policy = self.settings['flush_policy'],
+                                            flush_frames = self.settings['flush_frames'],
+                                            flush_period = self.settings['flush_period']),
+                        chunk_writer = ChunkWriter(self.settings['compression_workers']),
+                        queue_size = self.settings['write_queue_size'])
+
+    def dataset_options(self, shape):
+        return dataset_options(shape,
+                               chunking = self.settings['chunking'],
+                               compression = self.settings['compression'],
+                               compression_level = self.settings['compression_level'])
+
+    def update_status(self, writer):
+        self.settings['write_latency'] = writer.latency*1000
+        self.settings['write_queue_high_water'] = writer.high_water
@@ -1,6 +1,8 @@
 from ScopeFoundry import HardwareComponent
 from vimage_gen_device import VirtualImageGenDevice
+from vimage_gen_replay_device import ReplayDevice
 import numpy as np
+import time
 
 
 class VirtualImageGenHW(HardwareComponent):
@@ -12,22 +14,83 @@ class VirtualImageGenHW(HardwareComponent):
         # Define your hardware settings here.
         # These settings will be displayed in the GUI and auto-saved with data files
                 
+        self.settings.New(name='source', initial='synthetic', dtype=str, choices=['synthetic', 'replay'], ro=False)
+        self.settings.New(name='replay_file', initial='', dtype='file', is_dir=False, ro=False)
         self.settings.New(name='signal_amplitude', initial=500.0, dtype=float, ro=False, reread_from_hardware_after_write=False)
         self.settings.New(name='mean_particles', initial=10.0, dtype=int, ro=False, reread_from_hardware_after_write=False)
         self.settings.New(name='noise_amplitude', initial=100.0, dtype=float, ro=False, reread_from_hardware_after_write=False)
         self.settings.New(name='sizex', initial=520, dtype=int, ro=False, reread_from_hardware_after_write=False)    
         self.settings.New(name='sizey', initial=200, dtype=int, ro=False, reread_from_hardware_after_write=False)    
+        self.settings.New(name='render_mode', initial='patch', dtype=str, choices=['patch', 'sprite', 'full'], ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='prefetch', initial=False, dtype=bool, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='ring_size', initial=4, dtype=int, vmin=2, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='synthesis_workers', initial=0, dtype=int, vmin=0, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='seed', initial=-1, dtype=int, vmin=-1, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='exposure_time', initial=0.0, dtype=float, unit='s', vmin=0.0, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='frame_rate', initial=0.0, dtype=float, unit='Hz', vmin=0.0, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='particle_motion', initial='random', dtype=str, choices=['random', 'brownian', 'flow'], ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='particle_step', initial=1.0, dtype=float, unit='px', ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='channel_gains', initial='1.0, 0.5', dtype=str, ro=False, reread_from_hardware_after_write=False)
+        self.settings.New(name='dropped_frames', initial=0, dtype=int, ro=True)
+        self.settings.New(name='overruns', initial=0, dtype=int, ro=True)
+        self.settings.New(name='underruns', initial=0, dtype=int, ro=True)
  
     def connect(self):
         # Open connection to the device:
-        self.camera_device = VirtualImageGenDevice(
-            signal_amplitude = self.settings.signal_amplitude.val,
-            noise_amplitude = self.settings.noise_amplitude.val,
-            sizex = self.settings.sizex.val,
-            sizey = self.settings.sizey.val                
-            )
+        if self.settings['source'] == 'replay':
+            self.camera_device = ReplayDevice(
+                self.settings.replay_file.val,
+                frame_rate = self.settings.frame_rate.val,
+                exposure_time = self.settings.exposure_time.val,
+                ring_size = self.settings.ring_size.val
+                )
+            # the frame size is the one of the recorded images
+            self.settings.sizex.update_value(self.camera_device.sizex)
+            self.settings.sizey.update_value(self.camera_device.sizey)
+        else:
+            self.camera_device = VirtualImageGenDevice(
+                signal_amplitude = self.settings.signal_amplitude.val,
+                noise_amplitude = self.settings.noise_amplitude.val,
+                sizex = self.settings.sizex.val,
+                sizey = self.settings.sizey.val,
+                render_mode = self.settings.render_mode.val,
+                prefetch = self.settings.prefetch.val,
+                ring_size = self.settings.ring_size.val,
+                synthesis_workers = self.settings.synthesis_workers.val,
+                seed = self.settings.seed.val,
+                exposure_time = self.settings.exposure_time.val,
+                frame_rate = self.settings.frame_rate.val,
+                channel_gains = self.parse_channel_gains(self.settings.channel_gains.val),
+                particle_motion = self.settings.particle_motion.val,
+                particle_step = self.settings.particle_step.val
+                )
+            self.connect_synthesis_settings()
         
         # Connect settings to hardware:
+        self.settings.ring_size.connect_to_hardware(
+            write_func = self.camera_device.write_ring_size
+            )
+        self.settings.exposure_time.connect_to_hardware(
+            write_func = self.camera_device.write_exposure_time
+            )
+        self.settings.frame_rate.connect_to_hardware(
+            write_func = self.camera_device.write_frame_rate
+            )
+        self.settings.dropped_frames.connect_to_hardware(
+            read_func = self.camera_device.read_dropped_frames
+            )
+        self.settings.overruns.connect_to_hardware(
+            read_func = self.camera_device.read_overruns
+            )
+        self.settings.underruns.connect_to_hardware(
+            read_func = self.camera_device.read_underruns
+            )
+                            
+        #Take an initial sample of the data.
+        self.read_from_hardware()
+
+    def connect_synthesis_settings(self):
+        # Connect the settings used only by the synthetic camera:
         self.settings.signal_amplitude.connect_to_hardware(
             write_func = self.camera_device.write_signal_amp
             )
@@ -46,14 +109,43 @@ class VirtualImageGenHW(HardwareComponent):
         self.settings.mean_particles.connect_to_hardware(
             write_func = self.camera_device.write_mean_particles
             )
-                            
-        #Take an initial sample of the data.
-        self.read_from_hardware()
+        self.settings.render_mode.connect_to_hardware(
+            write_func = self.camera_device.write_render_mode
+            )
+        self.settings.prefetch.connect_to_hardware(
+            write_func = self.camera_device.write_prefetch
+            )
+        self.settings.synthesis_workers.connect_to_hardware(
+            write_func = self.camera_device.write_synthesis_workers
+            )
+        self.settings.seed.connect_to_hardware(
+            write_func = self.camera_device.write_seed
+            )
+        self.settings.particle_motion.connect_to_hardware(
+            write_func = self.camera_device.write_particle_motion
+            )
+        self.settings.particle_step.connect_to_hardware(
+            write_func = self.camera_device.write_particle_step
+            )
+        self.settings.channel_gains.connect_to_hardware(
+            write_func = lambda gains: self.camera_device.write_channel_gains(self.parse_channel_gains(gains))
+            )
         
+    def parse_channel_gains(self, gains):
+        return [float(gain) for gain in gains.split(',') if gain.strip()]
+
+    def threaded_update(self):
+        # Update the frame counters of the device
+        self.settings.dropped_frames.read_from_hardware()
+        self.settings.overruns.read_from_hardware()
+        self.settings.underruns.read_from_hardware()
+        time.sleep(0.5)
+
     def disconnect(self):
         # remove all hardware connections to settings
         self.settings.disconnect_all_from_hardware()
         
         # Don't just stare at it, clean up your objects when you're done!
         if hasattr(self, 'camera_device'):
+            self.camera_device.close()
             del self.camera_device
\ No newline at end of file
@@ -5,6 +5,7 @@ import pyqtgraph as pg
 import numpy as np
 import time
 import os
+from vimage_gen_h5 import H5Settings
 
 class VirtualImageGenMeasure(Measurement):
     
@@ -35,6 +36,7 @@ class VirtualImageGenMeasure(Measurement):
         self.settings.New('frame_num', dtype=int, initial=50)
         self.settings.New('time_lapse_num', dtype=int, initial=20)
         self.settings.New('sampling_period', dtype=float, unit='s', initial=0.1)
+        self.h5_settings = H5Settings(self.settings)
         self.settings.New('xsampling', dtype=float, unit='um', initial=0.5)
         self.settings.New('ysampling', dtype=float, unit='um', initial=0.5)
         self.settings.New('zsampling', dtype=float, unit='um', initial=3.0)
@@ -123,21 +125,25 @@ class VirtualImageGenMeasure(Measurement):
         self.camera.camera_device.start_acquisition()
         #self.camera.camera_device.store_frame()
 
-        while self.time_lapse_index < self.settings.time_lapse_num.val:
-            self.frame_index = 0
-            while self.frame_index < self.settings.frame_num.val:
-                self.img = self.camera.camera_device.get_frame()
-                self.images_h5[self.time_lapse_index][self.frame_index,:,:] = self.img
-                self.frame_index +=1
-                self.h5file.flush() # introduces a slight time delay but assures that images are stored continuosly 
-            if self.interrupt_measurement_called:
-                self.camera.camera_device.stop_acquisition()
-                break    
-            self.time_lapse_index +=1
-
-        self.camera.camera_device.stop_acquisition()
-
-        self.h5file.close()
+        try:
+            while self.time_lapse_index < self.settings.time_lapse_num.val:
+                self.frame_index = 0
+                stack = self.camera.camera_device.get_frames(self.settings.frame_num.val,
+                                                             interrupted = lambda: self.interrupt_measurement_called)
+                if stack.shape[0] == 0:
+                    break
+                self.h5_writer.write(self.images_h5[self.time_lapse_index].name, 0, stack) # the whole z-stack is written at once
+                self.img = stack[-1]
+                self.frame_index = stack.shape[0]
+                self.h5_writer.frame_done(stack.shape[0])
+                self.h5_settings.update_status(self.h5_writer)
+                if self.interrupt_measurement_called:
+                    break    
+                self.time_lapse_index +=1
+        finally:
+            self.camera.camera_device.stop_acquisition()
+            self.h5_writer.close() # writes the queued frames and closes the file
+            self.h5_settings.update_status(self.h5_writer)
         
         self.settings['save_h5'] = False
 
@@ -148,6 +154,7 @@ class VirtualImageGenMeasure(Measurement):
             os.makedirs(self.app.settings['save_dir'])
         self.h5file = h5_io.h5_base_file(app=self.app, measurement=self)
         self.h5_group = h5_io.h5_create_measurement_group(measurement=self, h5group=self.h5file)
+        self.h5_writer = self.h5_settings.create_writer(self.h5file) # the h5 file is written by a writer thread
 
 
 
@@ -156,11 +163,13 @@ class VirtualImageGenMeasure(Measurement):
         img_size = self.img.shape
         time_lapse_length = self.settings['time_lapse_num'] 
         length=self.settings['frame_num']
+        shape = [length, img_size[0], img_size[1]]
         self.images_h5 = []
         for tl_idx in range(time_lapse_length):
             dataset = self.h5_group.create_dataset(name  = f't{tl_idx}/c0/image', 
-                                                          shape = [length, img_size[0], img_size[1]],
-                                                          dtype = self.img.dtype)  
+                                                          shape = shape,
+                                                          dtype = self.img.dtype,
+                                                          **self.h5_settings.dataset_options(shape))  
             dataset.attrs['element_size_um'] =  [self.settings['zsampling'], self.settings['ysampling'], self.settings['xsampling']]
             self.images_h5.append(dataset)
             
@@ -5,6 +5,7 @@ import pyqtgraph as pg
 import numpy as np
 import time
 import os
+from vimage_gen_h5 import H5Settings
 
 class VirtualImageGenMeasure(Measurement):
     
@@ -40,6 +41,7 @@ class VirtualImageGenMeasure(Measurement):
         self.settings.New('zsampling', dtype=float, unit='um', initial=3.0)
         self.settings.New('save_h5', dtype=bool, initial=False)
         self.settings.New('sampling_period', dtype=float, unit='s', initial=0.1)
+        self.h5_settings = H5Settings(self.settings)
               
         # Define how often to update display during a run
         self.display_update_period = 0.05 
@@ -143,23 +145,25 @@ class VirtualImageGenMeasure(Measurement):
             self.time_lapse_index = 0
             while self.time_lapse_index < self.settings.time_lapse_num.val:
                 self.frame_index = 0
-                while self.frame_index < self.settings.frame_num.val:
-                    self.channel_index = 0 
-                    while self.channel_index < self.settings.channel_num.val:        
-                        self.img = self.camera.camera_device.get_frame()
-                        dataset_index=self.time_lapse_index*self.settings['channel_num'] + self.channel_index
-                        if self.settings['save_roi']:
-                            roi = self.img[50:200,50:200]    
-                            roi_h5[dataset_index][self.frame_index,:,:] = roi
-                        else:
-                            images_h5[dataset_index][self.frame_index,:,:] = self.img
-                        self.channel_index +=1
-                        self.h5file.flush() # introduces a slight time delay but assures that images are stored continuosly 
-                        if self.interrupt_measurement_called:
-                            break  
-                    self.frame_index +=1
-                    if self.interrupt_measurement_called:
-                        break   
+                self.channel_index = 0
+                # the z-stacks of all the channels are acquired in a single (z, c, y, x) block
+                stack = self.camera.camera_device.get_frames(znum*cnum,
+                                                             interrupted = lambda: self.interrupt_measurement_called)
+                acquired = stack.shape[0]//cnum # an interrupted stack is saved up to the last complete z plane
+                if acquired == 0:
+                    break
+                stack = stack[:acquired*cnum].reshape(acquired, cnum, *stack.shape[1:])
+                self.img = stack[-1,-1]
+                while self.channel_index < cnum:
+                    dataset_index=self.time_lapse_index*cnum + self.channel_index
+                    if self.settings['save_roi']:
+                        self.h5_writer.write(roi_h5[dataset_index].name, 0, stack[:,self.channel_index,50:200,50:200])
+                    else:
+                        self.h5_writer.write(images_h5[dataset_index].name, 0, stack[:,self.channel_index])
+                    self.channel_index +=1
+                self.h5_writer.frame_done(acquired*cnum)
+                self.h5_settings.update_status(self.h5_writer)
+                self.channel_index = 0
                 self.time_lapse_index +=1
                 if self.interrupt_measurement_called:
                     self.camera.camera_device.stop_acquisition()
@@ -167,7 +171,8 @@ class VirtualImageGenMeasure(Measurement):
 
         finally:
             self.camera.camera_device.stop_acquisition()
-            self.h5file.close()
+            self.h5_writer.close() # writes the queued frames and closes the file
+            self.h5_settings.update_status(self.h5_writer)
             delattr(self, 'h5file')
             delattr(self, 'h5_group')
             self.settings['save_h5'] = False
@@ -178,6 +183,7 @@ class VirtualImageGenMeasure(Measurement):
             os.makedirs(self.app.settings['save_dir'])
         self.h5file = h5_io.h5_base_file(app=self.app, measurement=self)
         self.h5_group = h5_io.h5_create_measurement_group(measurement=self, h5group=self.h5file)
+        self.h5_writer = self.h5_settings.create_writer(self.h5file) # the h5 file is written by a writer thread
 
 
     def init_h5_datasets(self,times_number=1,channels_number=1,z_number=1,
@@ -200,7 +206,8 @@ class VirtualImageGenMeasure(Measurement):
             for ch_idx in range(channels_number):
                 dataset = self.h5_group.create_dataset(name  = f't{tl_idx}/c{ch_idx}/{name}', 
                                                           shape = shape,
-                                                          dtype = dtype)  
+                                                          dtype = dtype,
+                                                          **self.h5_settings.dataset_options(shape))  
                 dataset.attrs['element_size_um'] =  [self.settings['zsampling'], self.settings['ysampling'], self.settings['xsampling']]
                 images_h5.append(dataset)
         
@@ -6,7 +6,9 @@ from pyqtgraph.Qt import QtWidgets
 import numpy as np
 import time
 import os
-from image_data import ImageManager
+from image_data import ImageManager, ImageBuffers
+from vimage_gen_pipeline import FramePipeline
+from vimage_gen_h5 import H5Settings
 
 class VirtualImageGenMeasure(Measurement):
     
@@ -36,8 +38,23 @@ class VirtualImageGenMeasure(Measurement):
 
         self.settings.New('saving_type', dtype=str, initial='None', choices=['None', 'Roi', 'Stack'])
         self.settings.New('roi_size', dtype=int, initial=60, vmin=2)
+        self.settings.New('roi_limit', dtype=int, initial=100, vmin=1)
         self.settings.New('min_object_area', dtype=int, initial=100, vmin=1)
         self.settings.New('max_object_area', dtype=int, initial=4000, vmin=1)
+        self.settings.New('detection_engine', dtype=str, initial='contours', choices=['contours', 'components'])
+        self.settings.New('threshold_method', dtype=str, initial='otsu', choices=['otsu', 'triangle', 'fixed'])
+        self.settings.New('fixed_threshold', dtype=int, initial=1000, vmin=0, vmax=65535)
+        self.settings.New('tile_size', dtype=int, initial=0, vmin=0)
+        self.settings.New('tile_workers', dtype=int, initial=4, vmin=1)
+        self.settings.New('tracking', dtype=bool, initial=False)
+        self.settings.New('redetect_period', dtype=int, initial=10, vmin=1)
+        self.settings.New('pipeline', dtype=bool, initial=False)
+        self.settings.New('detection_workers', dtype=int, initial=2, vmin=1)
+        self.settings.New('queue_size', dtype=int, initial=4, vmin=1)
+        self.settings.New('queue_policy', dtype=str, initial='block', choices=['block', 'drop_oldest', 'drop_newest'])
+        self.settings.New('detection_queue_depth', dtype=int, initial=0, ro=True)
+        self.settings.New('saving_queue_depth', dtype=int, initial=0, ro=True)
+        self.settings.New('pipeline_dropped_frames', dtype=int, initial=0, ro=True)
         self.settings.New('selected_channel', dtype=int, initial=0, vmin=0, vmax=1)
         self.settings.New('captured_objects', dtype=int, initial=0, ro=True)
         
@@ -55,6 +72,7 @@ class VirtualImageGenMeasure(Measurement):
 
         self.settings.New('detect', dtype=bool, initial=False)
         self.settings.New('sampling_period', dtype=float, unit='s', initial=0.1)
+        self.h5_settings = H5Settings(self.settings)
         
         # Convenient reference to the hardware used in the measurement
         self.camera = self.app.hardware['virtual_image_gen']
@@ -82,6 +100,8 @@ class VirtualImageGenMeasure(Measurement):
         # Set up pyqtgraph graph_layout in the UI
         self.imv = pg.ImageView()
         self.imv.ui.histogram.hide()
+        # the levels come from the histogram of the ImageManager, the hidden histogram does not scan the frames
+        self.imv.getImageItem().sigImageChanged.disconnect(self.imv.ui.histogram.imageChanged)
         self.ui.image_groupBox.layout().addWidget(self.imv)
         colors = [(0, 0, 0),
                   (45, 5, 61),
@@ -112,33 +132,40 @@ class VirtualImageGenMeasure(Measurement):
         
         #time0 = time.time()
         ch = self.settings.selected_channel.val
-        im = self.im.copy()
+        im = self.frames.read() # last complete frame, no copy
         img = im.image[ch,...]
 
-        self.imv.setImage(img,
-                        autoLevels = self.settings['auto_levels'],
-                        autoRange = self.settings['auto_range'],
-                        levelMode = 'mono'
-                        )
-            
         if self.settings['auto_levels']:
-            lmin,lmax = self.imv.getHistogramWidget().getLevels()
+            # the levels come from the same histogram used for thresholding
+            lmin,lmax = im.get_levels(ch)
             self.settings['level_min'] = lmin
             self.settings['level_max'] = lmax
-        else:
-            self.imv.setLevels( min= self.settings['level_min'],
-                                max= self.settings['level_max'])
 
-        for indx, cnt in enumerate(im.contours):
-            cnt = cnt.squeeze()
-            if cnt.ndim == 2 and len(cnt) > 1:
-                curve = pg.PlotCurveItem(cnt[:, 1], cnt[:, 0], pen=pg.mkPen('g', width=0.5))
-                self.imv.getView().addItem(curve)
-            x = int(im.cx[indx] - roisize//2)
-            y = int(im.cy[indx] - roisize//2)
-            rect = QtWidgets.QGraphicsRectItem(y, x, roisize, roisize)
-            rect.setPen(pg.mkPen(color='r', width=1))
-            self.imv.getView().addItem(rect)
+        # the frame goes straight to the image item: ImageView.setImage would scan it again for its own levels
+        self.imv.getImageItem().setImage(img,
+                        autoLevels = False,
+                        levels = (self.settings['level_min'], self.settings['level_max'])
+                        )
+        if self.settings['auto_range']:
+            self.imv.getView().autoRange()
+
+        # all the contours are plotted as a single curve, disconnected at the end of each contour
+        points = im.contour_points
+        if len(points) > 0:
+            connect = np.ones(len(points), dtype=bool)
+            connect[im.contour_offsets[1:]-1] = False
+            curve = pg.PlotCurveItem(points[:, 1], points[:, 0], connect=connect, pen=pg.mkPen('g', width=0.5))
+            self.imv.getView().addItem(curve)
+        # and so are the rectangles (the image is displayed transposed)
+        if len(im.objects) > 0:
+            x = im.cx.astype(int) - roisize//2
+            y = im.cy.astype(int) - roisize//2
+            rect_x = np.stack([y, y+roisize, y+roisize, y, y], axis=1).ravel()
+            rect_y = np.stack([x, x, x+roisize, x+roisize, x], axis=1).ravel()
+            connect = np.ones(len(rect_x), dtype=bool)
+            connect[4::5] = False
+            rects = pg.PlotCurveItem(rect_x, rect_y, connect=connect, pen=pg.mkPen(color='r', width=1))
+            self.imv.getView().addItem(rects)
 
 
         if self.settings['saving_type'] == 'Stack' and hasattr(self, 'frame_index') and hasattr(self, 'channel_index'):
@@ -152,90 +179,256 @@ class VirtualImageGenMeasure(Measurement):
 
     def pre_run(self):
         # Acquire initial image (1 for each channel) to set up the Image Manager
-        self.camera.camera_device.start_acquisition()    
-        self.channel_index = 0 
+        cnum = self.settings.channel_num.val
+        self.camera.camera_device.start_acquisition(channels=cnum) # camera specific function
         self.first_run = True # flag for initializing h5 roi file
-        while self.channel_index < self.settings.channel_num.val:
-            img = self.camera.camera_device.get_frame()
-            if self.channel_index == 0:
-                self.im = ImageManager(
-                        img.shape[1], img.shape[0],
-                        self.settings.roi_size.val,
-                        min_object_area = self.settings.min_object_area.val,
-                        max_object_area = self.settings.max_object_area.val,
-                        Nchannels=self.settings.channel_num.val,
-                        dtype=img.dtype
-                        )
-            self.im.image[self.channel_index,...] = img
-            self.channel_index +=1
+        imgs = self.camera.camera_device.get_channels(cnum) # camera specific function
+        self.im = ImageManager(
+                imgs.shape[2], imgs.shape[1],
+                self.settings.roi_size.val,
+                min_object_area = self.settings.min_object_area.val,
+                max_object_area = self.settings.max_object_area.val,
+                Nchannels=cnum,
+                dtype=imgs.dtype
+                )
+        self.im.image[...] = imgs
+        self.frames = ImageBuffers(self.im) # publishes the frames of self.im to the display
+        self.channel_index = cnum
 
 
     def run(self):
 
-        while not self.interrupt_measurement_called:
+        try:
+            if self.settings['pipeline']:
+                self.run_pipeline()
+                return
+
+            while not self.interrupt_measurement_called:
             
-            self.channel_index = 0
-            while self.channel_index < self.settings.channel_num.val:
-                
-                img = self.camera.camera_device.get_frame() # camera specific function
-                
-                self.im.image[self.channel_index,...] = img
-                self.channel_index +=1   
+                # all the channels are acquired at once, directly in a back buffer Image Manager,
+                # published to the display when the detection is complete
+                im = self.frames.back()
+                im.take_state(self.im)
+                self.im = im
+                self.camera.camera_device.get_channels(self.settings.channel_num.val, out=self.im.image) # camera specific function
+                self.im.clear_histograms()
+                self.channel_index = self.settings.channel_num.val
             
-            if self.settings['detect']:
-                self.detect_objects()
-            else:
-                self.settings['captured_objects'] = 0
-                self.im.clear_countours()      
-
-            if self.settings['saving_type'] == 'Roi':
-                if self.first_run:
-                    _ = self.init_h5()
-                    self.time_index = 0 # time index for h5 roi file
-                    self.first_run = False
-                self.save_roi()
+                if self.settings['detect']:
+                    self.detect_objects()
+                else:
+                    self.settings['captured_objects'] = 0
+                    self.im.clear_countours()      
+                self.frames.publish(self.im)
+
+                if self.settings['saving_type'] == 'Roi':
+                    if self.first_run:
+                        _ = self.init_h5()
+                        self.init_roi_datasets()
+                        self.first_run = False
+                    self.save_roi()
             
-            if self.settings['saving_type'] == 'Stack':
-                self.settings['captured_objects'] = 0
-                self.save_stack()
-                break
+                if self.settings['saving_type'] == 'Stack':
+                    self.settings['captured_objects'] = 0
+                    self.save_stack()
+                    break
 
-            if self.interrupt_measurement_called:
-                break
+                if self.interrupt_measurement_called:
+                    break
+        finally:
+            self.camera.camera_device.stop_acquisition()  # camera specific function 
+            if hasattr(self, 'h5file'): # interrupted, or failed, while saving
+                self.close_h5()
+                self.first_run = True
 
-        self.camera.camera_device.stop_acquisition()  # camera specific function 
+    def run_pipeline(self):
+        """
+        Same as run, with the acquisition in a thread, the detection in a pool of detection_workers threads
+        and the saving in the measurement thread, connected by queues of queue_size frames.
+        Each frame in flight has its own ImageManager.
+        The stages use the channels and detection settings of the start of the run
+        """
+        channels = self.settings.channel_num.val
+        params = self.detection_params()
+        workers = 1 if params['tracking'] else self.settings['detection_workers'] # tracking needs the previous frame
+        queue_size = self.settings['queue_size']
+        items = [self.im.copy() for _ in range(2*queue_size + workers + 4)]
+        tracked_im = self.im # ImageManager of the last detected frame, for tracking (used only by the detection stage)
+
+        def acquire(im):
+            self.acquire_frame(im, channels)
+
+        def process(im):
+            nonlocal tracked_im
+            tracked_im = self.process_frame(im, params, tracked_im)
+
+        pipeline = FramePipeline(acquire, process, items,
+                                 workers=workers, queue_size=queue_size, policy=self.settings['queue_policy'])
+        retired = [] # frames no longer published, to be released when the display stops reading them
+        previous_im = None # last frame got from the pipeline (the ImageManager of pre_run is not a pipeline item)
+        pipeline.start()
+        try:
+            while not self.interrupt_measurement_called:
+                im = pipeline.get()
+                if im is None:
+                    break
+                if previous_im is not None:
+                    retired.append(previous_im)
+                previous_im = im
+                self.im = im
+                self.frames.publish(im)
+                for old_im in list(retired):
+                    if not self.frames.in_use(old_im):
+                        retired.remove(old_im)
+                        pipeline.release(old_im)
+                self.settings['captured_objects'] = len(im.objects)
+                self.settings['detection_queue_depth'] = pipeline.input_queue.depth
+                self.settings['saving_queue_depth'] = pipeline.output_queue.depth
+                self.settings['pipeline_dropped_frames'] = pipeline.dropped
+                
+                if self.settings['saving_type'] == 'Roi':
+                    if self.first_run:
+                        _ = self.init_h5()
+                        self.init_roi_datasets()
+                        self.first_run = False
+                    self.save_roi()
+                
+                if self.settings['saving_type'] == 'Stack':
+                    pipeline.stop()
+                    self.settings['captured_objects'] = 0
+                    self.save_stack()
+                    break
+        finally:
+            pipeline.stop()
+
+    def acquire_frame(self, im, channels):
+        # acquisition stage of the pipeline
+        self.camera.camera_device.get_channels(channels, out=im.image) # camera specific function
+        im.clear_histograms()
 
+    def process_frame(self, im, params, tracked_im):
+        """
+        Detection stage of the pipeline: detects the objects of im with the detection parameters params,
+        continuing the tracking from tracked_im, the ImageManager of the previous frame.
+        Returns the ImageManager to track from at the next frame
+        """
+        if params['detect']:
+            if params['tracking']:
+                im.take_state(tracked_im)
+            self.detect_objects(im, params)
+        else:
+            im.clear_countours()
+        return im
     
+    def init_roi_datasets(self):
+        """
+        Creates the appendable datasets of the h5 roi file: the rois of all the channels, (N, C, roisize, roisize),
+        their index table (frame, object id, cx, cy), and the object and statistics tables
+        of all the frames, with the frame of each row
+        """
+        cnum = self.im.image.shape[0]
+        roisize = self.im.roisize
+        shape = (0, cnum, roisize, roisize)
+        options = self.h5_settings.dataset_options(shape)
+        options.setdefault('chunks', (1,) + shape[1:]) # a resizable dataset must be chunked
+        self.roi_dataset = self.h5_group.create_dataset(name = 'rois',
+                                                        shape = shape,
+                                                        maxshape = (None,) + shape[1:],
+                                                        dtype = self.im.image.dtype,
+                                                        **options)
+        self.roi_dataset.attrs['element_size_um'] = [self.settings['ysampling'], self.settings['xsampling']]
+        index_dtype = np.dtype([('frame', np.int64), ('id', np.int64), ('cx', np.int32), ('cy', np.int32)])
+        self.roi_index = self.h5_group.create_dataset(name = 'roi_index',
+                                                      shape = (0,),
+                                                      maxshape = (None,),
+                                                      chunks = (1024,),
+                                                      dtype = index_dtype)
+        self.objects_table = self.create_frame_table('objects', self.im.objects.dtype)
+        self.statistics_table = self.create_frame_table('statistics', self.im.statistics.dtype)
+        self.roi_count = 0     # rois saved
+        self.objects_index = 0 # frames saved
+
+    def create_frame_table(self, name, dtype):
+        """
+        Creates an appendable table with the fields of dtype and the frame of each row
+        """
+        table_dtype = np.dtype([('frame', np.int64)] + dtype.descr)
+        return self.h5_group.create_dataset(name = name,
+                                            shape = (0,),
+                                            maxshape = (None,),
+                                            chunks = (1024,),
+                                            dtype = table_dtype)
+
+    def append_frame_table(self, dataset, table):
+        """
+        Appends the rows of table to dataset, with the current frame
+        """
+        rows = np.zeros(len(table), dtype=dataset.dtype)
+        rows['frame'] = self.objects_index
+        for name in table.dtype.names:
+            rows[name] = table[name]
+        self.h5_writer.append(dataset.name, rows)
+
     def save_roi(self):
         im = self.im
-        cnum = self.settings['channel_num']
-        znum = 1 # TODO: self.settings['frame_num'] # change to znum when z-stacks are implemented
-        roisize = self.settings['roi_size']
+        rois = im.extract_rois_batch(im.cx, im.cy) # all the rois of all the channels, (N, C, roisize, roisize) 
+        # the object table and the intensity statistics of the frame are appended to the tables of all the frames
+        if len(im.objects) > 0:
+            self.append_frame_table(self.objects_table, im.objects)
+            self.append_frame_table(self.statistics_table, im.compute_statistics())
         
-        for roi_idx in range(len(im.cx)):
-            for ch_idx in range(cnum):
-                h5_roi_dataset = self.prepare_h5_dataset(self.time_index,
-                                channels_index=ch_idx,
-                                z_number=znum,
-                                imshape=[roisize,roisize],
-                                dtype=im.image.dtype,
-                                name='roi',
-                                )
-                roi = im.extract_rois(ch_idx,im.cx,im.cy)
-                h5_roi_dataset[0,:,:] = roi[roi_idx]
-                self.time_index += 1
-            self.h5file.flush() 
-
-            if self.interrupt_measurement_called or self.time_index >= 100:
-                self.close_h5()
-                self.settings['saving_type'] = 'None'
-                self.first_run = True
-                break
-
-    def detect_objects(self):
+        # the rois of the frame are appended to the roi dataset, up to roi_limit
+        num = min(rois.shape[0], self.settings['roi_limit'] - self.roi_count)
+        if num > 0:
+            index = np.zeros(num, dtype=self.roi_index.dtype)
+            index['frame'] = self.objects_index
+            index['id'] = im.ids[:num]
+            index['cx'] = im.cx[:num]
+            index['cy'] = im.cy[:num]
+            self.h5_writer.append(self.roi_dataset.name, rois[:num])
+            self.h5_writer.append(self.roi_index.name, index)
+            self.roi_count += num
+        self.objects_index += 1
+        self.h5_writer.frame_done()
+        self.h5_settings.update_status(self.h5_writer)
+
+        if self.interrupt_measurement_called or self.roi_count >= self.settings['roi_limit']:
+            self.close_h5()
+            self.settings['saving_type'] = 'None'
+            self.first_run = True
+
+    def detection_params(self):
+        """
+        Snapshot of the detection settings, for the detection stage of the pipeline
+        """
+        return {'detect': self.settings['detect'],
+                'tracking': self.settings['tracking'],
+                'channel': self.settings.selected_channel.val,
+                'engine': self.settings['detection_engine'],
+                'threshold_method': self.settings['threshold_method'],
+                'fixed_threshold': self.settings['fixed_threshold'],
+                'tile_size': self.settings['tile_size'],
+                'tile_workers': self.settings['tile_workers'],
+                'redetect_period': self.settings['redetect_period']}
+
+    def detect_objects(self, im=None, params=None):
         #time0 = time.time()
-        self.im.find_object(self.settings.selected_channel.val)
-        self.settings['captured_objects'] = len(self.im.contours)
+        if im is None:
+            im = self.im
+        if params is None:
+            params = self.detection_params()
+        im.engine = params['engine']
+        im.threshold_method = params['threshold_method']
+        im.fixed_threshold = params['fixed_threshold']
+        im.tile_size = params['tile_size']
+        im.tile_workers = params['tile_workers']
+        im.redetect_period = params['redetect_period']
+        if params['tracking']:
+            im.track_object(params['channel'])
+        else:
+            im.find_object(params['channel'])
+        if im is self.im:
+            self.settings['captured_objects'] = len(im.cx)
         #print(f'Objects {self.settings['captured_objects']} acquired in {time.time()-time0:.3f} s')
             
 
@@ -255,23 +448,21 @@ class VirtualImageGenMeasure(Measurement):
                                 name='stack',
                                 )
 
-        self.camera.camera_device.start_acquisition() # camera specific function
+        self.camera.camera_device.start_acquisition(channels=cnum) # camera specific function
 
         self.frame_index = 0
-        while self.frame_index < self.settings.frame_num.val:
-            self.channel_index = 0 
-            while self.channel_index < self.settings.channel_num.val:
-                
-                img = self.camera.camera_device.get_frame() # camera specific function
-                
-                images_h5[self.channel_index][self.frame_index,:,:] = img
-                self.h5file.flush() # introduces a slight time delay but assures that images are stored continuosly 
-                
-                self.channel_index +=1
+        self.channel_index = 0
+        # the z-stacks of all the channels are acquired in a single (z, c, y, x) block
+        stack = np.zeros((znum, cnum, *self.im.image.shape[1:]), dtype=self.im.image.dtype)
+        while self.frame_index < znum:
+            self.camera.camera_device.get_channels(cnum, out=stack[self.frame_index]) # camera specific function
             if self.interrupt_measurement_called:
-                    self.camera.camera_device.stop_acquisition()
-                    break
-            self.frame_index +=1  
+                break
+            self.frame_index +=1
+        while self.channel_index < cnum:
+            self.h5_writer.write(images_h5[self.channel_index].name, 0, stack[:,self.channel_index])
+            self.channel_index +=1
+        self.h5_writer.frame_done(self.frame_index*cnum)
 
         self.camera.camera_device.stop_acquisition() # camera specific function
         self.close_h5()
@@ -284,6 +475,7 @@ class VirtualImageGenMeasure(Measurement):
             os.makedirs(self.app.settings['save_dir'])
         self.h5file = h5_io.h5_base_file(app=self.app, measurement=self)
         self.h5_group = h5_io.h5_create_measurement_group(measurement=self, h5group=self.h5file)
+        self.h5_writer = self.h5_settings.create_writer(self.h5file) # the h5 file is written by a writer thread
         h5_dataset_list = [] # image_h5 is a of h5 datasets
         return h5_dataset_list
     
@@ -298,7 +490,8 @@ class VirtualImageGenMeasure(Measurement):
         for channel_idx in range(channels_number):
             dataset = self.h5_group.create_dataset(name = f't{time_index}/c{channel_idx}/{name}', 
                                                         shape = shape,
-                                                        dtype = dtype)  
+                                                        dtype = dtype,
+                                                        **self.h5_settings.dataset_options(shape))  
             dataset.attrs['element_size_um'] = [self.settings['zsampling'], self.settings['ysampling'], self.settings['xsampling']]
             h5_dataset_list.append(dataset)
     
@@ -311,7 +504,8 @@ class VirtualImageGenMeasure(Measurement):
         shape=[z_number, imshape[0], imshape[1]]
         h5_dataset = self.h5_group.create_dataset(name = f't{time_index}/c{channels_index}/{name}', 
                                                         shape = shape,
-                                                        dtype = dtype)
+                                                        dtype = dtype,
+                                                        **self.h5_settings.dataset_options(shape))
         h5_dataset.attrs['element_size_um'] = [self.settings['zsampling'], self.settings['ysampling'], self.settings['xsampling']]
               
         return h5_dataset    
@@ -321,8 +515,11 @@ class VirtualImageGenMeasure(Measurement):
         return h5_dataset
     
     def close_h5(self):
-        self.h5file.close()
-        if hasattr(self,'h5file'):  
-            delattr(self, 'h5file')
-        if hasattr(self,'h5_group'):    
-            delattr(self, 'h5_group')
\ No newline at end of file
+        try:
+            self.h5_writer.close() # writes the queued frames and closes the file
+            self.h5_settings.update_status(self.h5_writer)
+        finally:
+            if hasattr(self,'h5file'):  
+                delattr(self, 'h5file')
+            if hasattr(self,'h5_group'):    
+                delattr(self, 'h5_group')
\ No newline at end of file
@@ -0,0 +1,187 @@
+'''
+Pipelined frame processing for the measurements.
+
+An acquisition thread fills the frames, a pool of worker threads processes them
+and the consumer (the measurement thread, that saves them) gets them back in acquisition order.
+The stages are connected by bounded queues, with a policy for full queues.
+'''
+
+import threading
+import queue
+from collections import deque
+
+
+class StageQueue(object):
+    """
+    Bounded FIFO queue between two pipeline stages.
+    When the queue is full, put() applies the policy:
+    'block' waits for a free place, 'drop_oldest' discards the oldest item,
+    'drop_newest' discards the item being put.
+    """
+
+    def __init__(self, maxsize, policy='block'):
+        if policy not in ('block', 'drop_oldest', 'drop_newest'):
+            raise ValueError(f'Unknown queue policy {policy}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.high_water = 0 # maximum depth reached
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    def put(self, item):
+        """
+        Puts item in the queue and returns the discarded item, or None.
+        Raises RuntimeError if the queue is stopped
+        """
+        dropped = None
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError('put on a stopped queue')
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'block':
+                    self.cond.wait_for(lambda: len(self.items) < self.maxsize or self.stopped)
+                    if self.stopped:
+                        raise RuntimeError('put on a stopped queue')
+                elif self.policy == 'drop_oldest':
+                    dropped = self.items.popleft()
+                else:
+                    return item
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.cond.notify_all()
+        return dropped
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest item, or None if the queue was stopped or the timeout expired
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.stopped, timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+class FramePipeline(object):
+    """
+    acquisition thread -> StageQueue -> worker threads -> StageQueue -> get()
+    acquire(item) fills a item (e.g. a ImageManager) and process(item) processes it in a worker.
+    items are the reusable items of the pipeline: the consumer gets them with get(),
+    in acquisition order, and gives them back with release() when they are no longer used.
+    Frames dropped by the queues are skipped, and counted in dropped.
+    There must be more items than the ones that can be in the queues and in the stages,
+    otherwise the acquisition waits for a released item
+    """
+
+    def __init__(self, acquire, process, items, workers=2, queue_size=4, policy='block'):
+        self.acquire = acquire
+        self.process = process
+        self.free = queue.Queue()
+        for item in items:
+            self.free.put(item)
+        self.workers = workers
+        self.input_queue = StageQueue(queue_size, policy)   # acquired frames, waiting for a worker
+        self.output_queue = StageQueue(queue_size, policy)  # processed frames, waiting for the consumer
+        self.lock = threading.Lock()
+        self.skipped = set()   # sequence numbers of the dropped frames
+        self.pending = {}      # processed frames arrived before the previous ones
+        self.next_number = 0   # sequence number of the next frame for the consumer
+        self.dropped = 0
+        self.stopped = False
+        self.error = None
+        self.threads = []
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._acquire_frames, daemon=True)]
+        self.threads += [threading.Thread(target=self._process_frames, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.input_queue.stop()
+        self.output_queue.stop()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _fail(self, error):
+        if self.stopped:
+            return # the queues were stopped under the stage
+        self.error = error
+        self.stopped = True
+        self.input_queue.stop()
+        self.output_queue.stop()
+
+    def _drop(self, entry):
+        number, item = entry
+        with self.lock:
+            self.skipped.add(number)
+            self.dropped += 1
+        self.free.put(item)
+
+    def _acquire_frames(self):
+        number = 0
+        try:
+            while not self.stopped:
+                try:
+                    item = self.free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self.acquire(item)
+                dropped = self.input_queue.put((number, item))
+                number += 1
+                if dropped is not None:
+                    self._drop(dropped)
+        except Exception as error:
+            self._fail(error)
+
+    def _process_frames(self):
+        try:
+            while not self.stopped:
+                entry = self.input_queue.get()
+                if entry is None:
+                    break
+                self.process(entry[1])
+                dropped = self.output_queue.put(entry)
+                if dropped is not None:
+                    self._drop(dropped)
+        except Exception as error:
+            self._fail(error)
+
+    def get(self, timeout=0.1):
+        """
+        Returns the next processed item in acquisition order,
+        or None if the pipeline was stopped (raising the error of a failed stage)
+        """
+        while True:
+            with self.lock:
+                while self.next_number in self.skipped:
+                    self.skipped.remove(self.next_number)
+                    self.next_number += 1
+            item = self.pending.pop(self.next_number, None)
+            if item is not None:
+                self.next_number += 1
+                return item
+            if self.error is not None:
+                raise self.error
+            if self.stopped:
+                return None
+            entry = self.output_queue.get(timeout)
+            if entry is not None:
+                self.pending[entry[0]] = entry[1]
+
+    def release(self, item):
+        self.free.put(item)
@@ -0,0 +1,123 @@
+'''
+Multi-process frame synthesis for VirtualImageGenDevice.
+
+The frame is split in horizontal bands, each rendered by a worker process
+directly into uint16 frames held in shared memory,
+so that no image data is pickled between the processes.
+The workers are started with the 'spawn' method and import only numpy
+and the rendering modules, not the Qt libraries of the application.
+'''
+
+import numpy as np
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from vimage_gen_psf import PSFSpriteCache, gaussian_psf
+from vimage_gen_render import to_uint16, render_full, render_patch
+
+# Worker process globals, set by _init_worker
+_shm = None
+_frames = None
+_x = None
+_y = None
+_sprites = None
+_grids = {}
+
+
+def _init_worker(shm_name, channels, sizex, sizey):
+    global _shm, _frames, _x, _y, _sprites
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _frames = np.ndarray((channels, sizey, sizex), dtype=np.uint16, buffer=_shm.buf)
+    _x = np.linspace(-sizex/2, sizex/2, sizex)
+    _y = np.linspace(-sizey/2, sizey/2, sizey)
+    _sprites = PSFSpriteCache()
+
+
+def _render_particles(r0, r1, particles, render_mode, nsigma, psf):
+    """
+    Renders the particles (unit amplitude) in the rows r0:r1 of the frame and returns them
+    """
+    X0, Y0, sigma = particles
+    z = np.zeros((r1-r0, _x.size), dtype=np.float32)
+    if render_mode == 'full':
+        if (r0, r1) not in _grids:
+            _grids[(r0, r1)] = np.meshgrid(_x, _y[r0:r1])
+        X, Y = _grids[(r0, r1)]
+        render_full(z, X, Y, X0, Y0, sigma)
+    elif render_mode == 'sprite':
+        if psf is None:
+            psf = gaussian_psf
+        if _sprites.psf is not psf or _sprites.nsigma != nsigma:
+            _sprites.psf = psf
+            _sprites.nsigma = nsigma
+            _sprites.clear()
+        dx = _x[1]-_x[0]
+        dy = _y[1]-_y[0]
+        _sprites.stamp(z, (X0-_x[0])/dx, (Y0-_y[0])/dy - r0, sigma/dx)
+    else:
+        render_patch(z, _x, _y[r0:r1], X0, Y0, sigma, nsigma)
+    return z
+
+
+def _render_band(r0, r1, seed, noise_amplitude, signal_amplitudes, particles, render_mode, nsigma, psf):
+    """
+    Renders the rows r0:r1 of the shared frames: noise + particles,
+    scaled by the signal amplitude of each channel
+    """
+    rng = np.random.Generator(np.random.PCG64(seed))
+    z = None
+    if particles is not None and len(particles[0]) > 0:
+        z = _render_particles(r0, r1, particles, render_mode, nsigma, psf)
+    for ch, signal_amplitude in enumerate(signal_amplitudes):
+        img = rng.random((r1-r0, _x.size), dtype=np.float32)
+        img *= noise_amplitude
+        img += 1
+        if z is not None:
+            img += signal_amplitude*z
+        to_uint16(img, _frames[ch, r0:r1])
+
+
+class SynthesisPool(object):
+    """
+    Pool of worker processes rendering the bands of channels sizey x sizex frames
+    into a shared memory buffer.
+    close() must be called to terminate the workers and release the shared memory.
+    """
+
+    def __init__(self, workers, sizex, sizey, channels=1):
+        self.workers = workers
+        self.sizex = sizex
+        self.sizey = sizey
+        self.channels = channels
+        self.shm = shared_memory.SharedMemory(create=True, size=channels*sizex*sizey*np.dtype(np.uint16).itemsize)
+        self.frames = np.ndarray((channels, sizey, sizex), dtype=np.uint16, buffer=self.shm.buf)
+        self.bands = np.linspace(0, sizey, workers+1).astype(int)
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.get_context('spawn').Pool(workers,
+                                                              initializer=_init_worker,
+                                                              initargs=(self.shm.name, channels, sizex, sizey))
+
+    def render(self, seeds, noise_amplitude, signal_amplitudes, particles,
+               render_mode='patch', nsigma=5.0, psf=None):
+        """
+        Renders the channels with the particles (X0, Y0, sigma), or None for a frame without particles,
+        and returns the shared (channels, sizey, sizex) uint16 frames.
+        seeds are the seeds (e.g. SeedSequence) of the noise of each band,
+        signal_amplitudes the signal amplitude of each channel.
+        render_mode is 'patch', 'sprite' (with the PSF function psf) or 'full'.
+        The frames are overwritten by the next call
+        """
+        tasks = [(self.bands[idx], self.bands[idx+1], seeds[idx],
+                  noise_amplitude, signal_amplitudes, particles, render_mode, nsigma, psf)
+                 for idx in range(self.workers)]
+        with self.lock:
+            self.pool.starmap(_render_band, tasks)
+        return self.frames
+
+    def close(self):
+        with self.lock: # waits for the frames being rendered
+            self.pool.terminate()
+            self.pool.join()
+            del self.frames
+            self.shm.close()
+            self.shm.unlink()
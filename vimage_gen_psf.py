@@ -0,0 +1,119 @@
+'''
+Point spread function sprites for VirtualImageGenDevice.
+
+Particles are drawn by adding pre-rendered PSF kernels (sprites) into the frame.
+Sprites are cached, keyed by quantized sigma (in relative steps) and sub-pixel offset of the particle center.
+'''
+
+import numpy as np
+from collections import OrderedDict
+
+
+def gaussian_psf(sigma, fx, fy, half):
+    """
+    Gaussian PSF sampled on a (2*half+1, 2*half+1) pixel grid, with the center
+    displaced by (fx, fy) pixels from the central pixel.
+    All the lengths are in pixel units.
+    A measured PSF can be used in place of this function, as long as it has the same signature
+    """
+    k = np.arange(-half, half+1)
+    gx = np.exp(-(k-fx)**2 / (2*sigma**2))
+    gy = np.exp(-(k-fy)**2 / (2*sigma**2))
+    return np.outer(gy, gx)
+
+
+class PSFSpriteCache(object):
+    """
+    Cache of PSF sprites with least recently used eviction, bounded to max_bytes.
+    sigma_ratio: quantization of sigma, in relative (logarithmic) steps: sigma = sigma_ratio**qsigma
+    offset_step: quantization of the sub-pixel offset of the center, in sigmas,
+    with at most subpixel positions per pixel (wide sprites have a single position per pixel)
+    nsigma: half size of the sprites, in sigmas
+    The sprites are stored as float32
+    """
+
+    def __init__(self, psf=gaussian_psf,
+                 max_bytes=64*2**20,
+                 sigma_ratio=1.05,
+                 offset_step=0.05,
+                 subpixel=8,
+                 nsigma=5.0):
+        self.psf = psf
+        self.max_bytes = max_bytes
+        self.sigma_ratio = sigma_ratio
+        self.offset_step = offset_step
+        self.subpixel = subpixel
+        self.nsigma = nsigma
+        self.sprites = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.sprites.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def positions(self, qsigma):
+        """
+        Number of sub-pixel positions per pixel of the sprites with sigma = sigma_ratio**qsigma
+        """
+        sigma = self.sigma_ratio**qsigma
+        return np.clip(np.ceil(1/(self.offset_step*sigma)), 1, self.subpixel).astype(int)
+
+    def get_sprite(self, qsigma, qx, qy):
+        """
+        Returns the sprite for sigma = sigma_ratio**qsigma and
+        sub-pixel offsets qx/n, qy/n, with n = positions(qsigma)
+        """
+        key = (qsigma, qx, qy)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            self.hits += 1
+            return sprite
+        self.misses += 1
+        sigma = self.sigma_ratio**qsigma
+        half = int(np.ceil(self.nsigma * sigma))
+        n = self.positions(qsigma)
+        sprite = np.asarray(self.psf(sigma, qx/n, qy/n, half), dtype=np.float32)
+        sprite.flags.writeable = False
+        self.sprites[key] = sprite
+        self.nbytes += sprite.nbytes
+        while self.nbytes > self.max_bytes and len(self.sprites) > 1:
+            self.nbytes -= self.sprites.popitem(last=False)[1].nbytes
+        return sprite
+
+    def stamp(self, z, u, v, sigma, amplitude=None):
+        """
+        Adds the sprites of the particles into z.
+        u, v: particle centers in pixel units (column and row index of z)
+        sigma: particle sigmas in pixel units, particles with sigma 0 are skipped
+        amplitude: peak value of each particle (1 if not specified)
+        """
+        sizey, sizex = z.shape
+        sigma = np.abs(sigma)
+        qsigma = np.rint(np.log(np.where(sigma > 0, sigma, 1))/np.log(self.sigma_ratio)).astype(int)
+        n = self.positions(qsigma)
+        iu = np.rint(u).astype(int)
+        iv = np.rint(v).astype(int)
+        qx = np.rint((u-iu)*n).astype(int)
+        qy = np.rint((v-iv)*n).astype(int)
+        for idx, (i, j, fx, fy, qs) in enumerate(zip(iu, iv, qx, qy, qsigma)):
+            if sigma[idx] == 0:
+                continue
+            sprite = self.get_sprite(qs, fx, fy)
+            half = sprite.shape[0]//2
+            i0, i1 = max(i-half, 0), min(i+half+1, sizex)
+            j0, j1 = max(j-half, 0), min(j+half+1, sizey)
+            if i0 >= i1 or j0 >= j1:
+                continue # sprite outside of the frame
+            window = sprite[j0-j+half:j1-j+half, i0-i+half:i1-i+half]
+            scale = 1 if amplitude is None else amplitude[idx]
+            if scale == 1:
+                z[j0:j1, i0:i1] += window
+            elif scale == -1:
+                z[j0:j1, i0:i1] -= window # erased by the incremental renders
+            else:
+                z[j0:j1, i0:i1] += scale*window
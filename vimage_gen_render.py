@@ -0,0 +1,98 @@
+'''
+Frame rendering functions of the virtual image generator.
+
+They depend on numpy only (no Qt), so that the synthesis worker processes
+can import them without loading the GUI libraries.
+'''
+
+import numpy as np
+
+
+def to_uint16(img, out):
+    """
+    Saturating conversion of a frame to uint16, written in out.
+    Float frames are clipped in place
+    """
+    if img.dtype != np.uint16:
+        np.maximum(img, 0, out=img) # np.clip with out leaves an allocation per call
+        np.minimum(img, 65535, out=img)
+    np.copyto(out, img, casting='unsafe')
+
+
+def render_full(z, X, Y, X0, Y0, sigma, amplitude=None, work=None):
+    """
+    Adds the particles to z evaluating each Gaussian over the whole grid X, Y.
+    Reference implementation: cost is O(particles x pixels).
+    amplitude, if specified, is the peak value of each particle (1 otherwise).
+    work, if specified, is a (2,)+X.shape float array used for the intermediate results
+    """
+    if work is None:
+        work = np.zeros((2,)+X.shape)
+    r2, dy2 = work
+    for idx in range(len(X0)):
+        np.subtract(X, X0[idx], out=r2)
+        np.square(r2, out=r2)
+        np.subtract(Y, Y0[idx], out=dy2)
+        np.square(dy2, out=dy2)
+        r2 += dy2
+        r2 *= -1/(2*sigma[idx]**2)
+        np.exp(r2, out=r2)
+        if amplitude is not None:
+            r2 *= amplitude[idx]
+        z += r2
+
+
+def render_patch(z, x, y, X0, Y0, sigma, nsigma=5.0, amplitude=None, work=None):
+    """
+    Adds the particles to z evaluating each Gaussian only inside a window
+    of nsigma sigmas around its center, as the outer product
+    of two 1D profiles.
+    x and y are the (sorted) coordinates of the columns and rows of z.
+    amplitude, if specified, is the peak value of each particle (1 otherwise).
+    work, if specified, are the buffers used for the profiles and the patches:
+    (len(x),) and (len(y),) float arrays and an array with the shape of z
+    (or None, to allocate each patch)
+    """
+    if work is None:
+        work = (np.zeros(len(x)), np.zeros(len(y)), None)
+    gx_work, gy_work, patch_work = work
+    for idx in range(len(X0)):
+        x0 = X0[idx]
+        y0 = Y0[idx]
+        s = abs(sigma[idx])
+        if s == 0:
+            continue
+        half = nsigma * s
+        i0 = x.searchsorted(x0 - half)
+        i1 = x.searchsorted(x0 + half)
+        j0 = y.searchsorted(y0 - half)
+        j1 = y.searchsorted(y0 + half)
+        if i0 >= i1 or j0 >= j1:
+            continue # particle window outside of the frame
+        gx = gx_work[:i1-i0]
+        gy = gy_work[:j1-j0]
+        for g, coords, c0 in ((gx, x[i0:i1], x0), (gy, y[j0:j1], y0)):
+            np.subtract(coords, c0, out=g)
+            np.square(g, out=g)
+            g *= -1/(2*s**2)
+            np.exp(g, out=g)
+        if amplitude is not None:
+            gy *= amplitude[idx]
+        if patch_work is None:
+            patch = np.multiply.outer(gy, gx)
+        else:
+            patch = patch_work[:j1-j0, :i1-i0]
+            np.multiply.outer(gy, gx, out=patch)
+        window = z[j0:j1, i0:i1]
+        window += patch
+
+
+def render_sprites(z, x, y, X0, Y0, sigma, sprites, amplitude=None):
+    """
+    Adds the particles to z stamping the PSF sprites of sprites (a PSFSpriteCache).
+    x and y are the (uniformly spaced) coordinates of the columns and rows of z.
+    amplitude, if specified, is the peak value of each particle (1 otherwise)
+    """
+    dx = x[1]-x[0]
+    dy = y[1]-y[0]
+    sprites.stamp(z, (X0-x[0])/dx, (Y0-y[0])/dy, sigma/dx, amplitude)
@@ -0,0 +1,199 @@
+import numpy as np
+import h5py
+import re
+import threading
+from vimage_gen_device import FrameClock, FrameRing
+
+
+class ReplayDevice(object):
+    """
+    Replay camera: serves the frames saved in an HDF5 file by the measurements
+    (datasets t{i}/c{j}/image or t{i}/c{j}/stack), looping over them at frame_rate.
+    It has the same acquisition interface of VirtualImageGenDevice.
+    Contiguous datasets are memory-mapped, chunked ones are read through the HDF5 chunk cache.
+    During the acquisition a reader thread reads ahead into a ring of ring_size buffers
+    """
+
+    def __init__(self,
+                 filename,
+                 frame_rate = 0.0,
+                 exposure_time = 0.0,
+                 ring_size = 4,
+                 cache_size = 64*2**20):
+        self.h5file = h5py.File(filename, 'r', rdcc_nbytes=cache_size)
+        self.sources = self.find_sources(self.h5file)
+        if not self.sources:
+            self.h5file.close()
+            raise ValueError(f'No image or stack datasets found in {filename}')
+        self.times = len(self.sources)
+        self.channels = len(self.sources[0])
+        self.depth, self.sizey, self.sizex = self.sources[0][0].shape
+        self.frame_rate = frame_rate # frames per second, 0 to read at disk speed
+        self.exposure_time = exposure_time
+        self.ring_size = ring_size
+        self.index = 0 # index of the next frame (or channel set) to read
+        self.frame_number = -1
+        self.frame_timestamp = 0.0
+        self._clock = FrameClock(self.frame_period)
+        self._ring = None
+        self._reader = None
+
+    @staticmethod
+    def find_sources(h5file):
+        """
+        Returns the image datasets of the file as a list (over the time index)
+        of lists (over the channel index) of arrays: memory maps for the contiguous datasets,
+        h5py datasets otherwise
+        """
+        found = {}
+        def visit(name, obj):
+            match = re.search(r't(\d+)/c(\d+)/(image|stack)$', name)
+            if match and isinstance(obj, h5py.Dataset) and obj.ndim == 3:
+                found.setdefault(int(match.group(1)), {})[int(match.group(2))] = obj
+        h5file.visititems(visit)
+        sources = []
+        for t_idx in sorted(found):
+            channels = found[t_idx]
+            sources.append([ReplayDevice.map_dataset(channels[c_idx]) for c_idx in sorted(channels)])
+        return sources
+
+    @staticmethod
+    def map_dataset(dataset):
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and dataset.compression is None and offset is not None:
+            return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype,
+                             offset=offset, shape=dataset.shape)
+        return dataset
+
+    @property
+    def frame_period(self):
+        period = 1.0/self.frame_rate if self.frame_rate > 0 else 0.0
+        return max(period, self.exposure_time)
+
+    def write_frame_rate(self, frame_rate):
+        self.frame_rate = frame_rate
+        self._clock.set_period(self.frame_period)
+
+    def write_exposure_time(self, exposure_time):
+        self.exposure_time = exposure_time
+        self._clock.set_period(self.frame_period)
+
+    def write_ring_size(self, ring_size):
+        self.ring_size = ring_size
+
+    def read_dropped_frames(self):
+        dropped = self._clock.dropped
+        if self._ring is not None:
+            dropped += self._ring.overruns
+        return dropped
+
+    def read_overruns(self):
+        return self._ring.overruns if self._ring is not None else 0
+
+    def read_underruns(self):
+        return self._ring.underruns if self._ring is not None else 0
+
+    def read(self, out):
+        """
+        Reads the next frame (2D out) or channel set (3D out) and moves to the following one,
+        looping at the end of the file.
+        Frames are in acquisition order: time, z, channel
+        """
+        if out.ndim == 3:
+            t_idx, z_idx = divmod(self.index % (self.times*self.depth), self.depth)
+            for ch in range(out.shape[0]):
+                self._read_plane(self.sources[t_idx][ch % self.channels], z_idx, out[ch])
+        else:
+            k = self.index % (self.times*self.depth*self.channels)
+            t_idx, k = divmod(k, self.depth*self.channels)
+            z_idx, c_idx = divmod(k, self.channels)
+            self._read_plane(self.sources[t_idx][c_idx], z_idx, out)
+        self.index += 1
+        return out
+
+    def _read_plane(self, source, z_idx, out):
+        if isinstance(source, np.ndarray):
+            np.copyto(out, source[z_idx], casting='unsafe')
+        elif source.dtype == out.dtype:
+            source.read_direct(out, np.s_[z_idx])
+        else:
+            np.copyto(out, source[z_idx], casting='unsafe')
+
+    def start_acquisition(self, channels=None):
+        """
+        Starts the reader thread from the beginning of the file. If channels is specified,
+        the ring is filled with (channels, sizey, sizex) channel sets, to be read with get_channels
+        """
+        self.stop_acquisition()
+        self.index = 0
+        self._clock = FrameClock(self.frame_period)
+        shape = (self.sizey, self.sizex) if channels is None else (channels, self.sizey, self.sizex)
+        self._ring = FrameRing(self.ring_size, shape)
+        self._reader = threading.Thread(target=self._read_frames,
+                                        args=(self._ring, self._clock),
+                                        daemon=True)
+        self._reader.start()
+
+    def stop_acquisition(self):
+        if self._reader is not None:
+            self._ring.stop()
+            self._reader.join()
+            self._reader = None
+
+    def _read_frames(self, ring, clock):
+        try:
+            while not ring.stopped:
+                idx = ring.acquire_free()
+                if idx is None:
+                    break
+                self.read(ring.buffers[idx])
+                ring.numbers[idx], ring.timestamps[idx] = clock.wait_next()
+                ring.publish(idx)
+        finally:
+            ring.stop()
+
+    def _acquire(self, out):
+        info = None
+        if self._reader is not None and self._ring.buffers.shape[1:] == out.shape:
+            info = self._ring.get(out)
+        if info is None:
+            self.read(out)
+            info = self._clock.wait_next()
+        self.frame_number, self.frame_timestamp = info
+        return info
+
+    def get_frame(self, out=None):
+        if out is None:
+            out = np.empty((self.sizey, self.sizex), dtype=np.uint16)
+        self._acquire(out)
+        return out
+
+    def get_channels(self, channels, out=None):
+        if out is None:
+            out = np.empty((channels, self.sizey, self.sizex), dtype=np.uint16)
+        self._acquire(out)
+        return out
+
+    def get_frames(self, n, out=None, interrupted=None):
+        if out is None:
+            out = np.empty((n, self.sizey, self.sizex), dtype=np.uint16)
+        self.frame_numbers = np.zeros(n, dtype=np.int64)
+        self.frame_timestamps = np.zeros(n)
+        for idx in range(n):
+            if interrupted is not None and interrupted():
+                self.frame_numbers = self.frame_numbers[:idx]
+                self.frame_timestamps = self.frame_timestamps[:idx]
+                return out[:idx]
+            self.frame_numbers[idx], self.frame_timestamps[idx] = self._acquire(out[idx])
+        return out
+
+    def store_frame(self):
+        self._frame = self.get_frame()
+
+    def get_stored_frame(self):
+        return(self._frame)
+
+    def close(self):
+        self.stop_acquisition()
+        self.sources = []
+        self.h5file.close()